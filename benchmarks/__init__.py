@@ -0,0 +1,62 @@
+"""
+Benchmarks for the chat app. Run them from the repository root, e.g.
+
+    $ python -m benchmarks.lookups --rows 1000000
+
+Each benchmark runs against its own database so it never touches the
+development data.
+"""
+import os
+import tempfile
+
+
+def setup(database=None, postgres=None):
+    """
+    Configures Django against a benchmark database and migrates it. The
+    database is SQLite unless the name of a local PostgreSQL database is
+    given, which requires psycopg2.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat.settings")
+    os.environ.setdefault("secret_key", "benchmark")
+
+    from django.conf import settings
+    if postgres:
+        try:
+            import psycopg2
+        except ImportError:
+            raise SystemExit('Benchmarking against PostgreSQL requires the psycopg2 package.')
+        settings.DATABASES['default'] = {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': postgres,
+            'HOST': os.getenv('PGHOST', 'localhost'),
+            'USER': os.getenv('PGUSER', ''),
+            'PASSWORD': os.getenv('PGPASSWORD', ''),
+        }
+    else:
+        settings.DATABASES['default'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': database or os.path.join(tempfile.gettempdir(), 'chat-benchmark.sqlite3'),
+        }
+    settings.ROOT_DIR = tempfile.mkdtemp(prefix='chat-benchmark-')
+    settings.CHAT_TASK_BACKEND = 'chat.workers.SyncBackend'
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def summarize(timings):
+    """
+    Returns the mean, median and 99th percentile of a list of timings,
+    in milliseconds.
+    """
+    timings = sorted(timings)
+    count = len(timings)
+    return {
+        'count': count,
+        'mean_ms': 1000.0 * sum(timings) / count,
+        'p50_ms': 1000.0 * timings[count // 2],
+        'p99_ms': 1000.0 * timings[min(count - 1, int(count * 0.99))],
+    }
@@ -0,0 +1,81 @@
+"""
+Measures how many Slack events per second SlackEventHandler.handle
+dispatches. The queued tasks are discarded so only the handler is timed.
+
+    $ python -m benchmarks.events --events 100000
+"""
+import argparse
+import json
+import time
+from benchmarks import setup
+from chat.workers import BaseBackend
+
+
+class NullBackend(BaseBackend):
+    """
+    Drops the queued tasks.
+    """
+    def enqueue(self, task_name, args, kwargs, key=None):
+        pass
+
+
+def build_requests(token):
+    """
+    Returns a request for each kind of event the handler sees.
+    """
+    from django.test.client import RequestFactory
+    factory = RequestFactory()
+
+    def message(channel, **extra):
+        event = {'type': 'message', 'channel': channel, 'user': 'U1', 'text': 'Hi', 'ts': '1500000000.000100'}
+        event.update(extra)
+        body = json.dumps({'token': token, 'type': 'event_callback', 'event': event})
+        return factory.post('/slack/', body, content_type='application/json')
+
+    return {
+        'logged_message': message('CLOGGED'),
+        'logged_edit': message('CLOGGED', subtype='message_changed', message={'ts': '1500000000.000100'}),
+        'logged_unknown_subtype': message('CLOGGED', subtype='channel_join'),
+        'unlogged_message': message('CUNLOGGED'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, default=100000)
+    args = parser.parse_args()
+
+    setup()
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from chat.events import SlackEventHandler
+    from chat.models import ChatChannel
+
+    settings.CHAT_TASK_BACKEND = 'benchmarks.events.NullBackend'
+    settings.SLACK_VERIFICATION_TOKEN = 'benchmark'
+    ChatChannel.objects.all().delete()
+    ChatChannel.objects.bulk_create([ChatChannel(channel_id='CLOGGED', slug='logged', headline='Logged')])
+
+    handler = SlackEventHandler()
+    results = {}
+    for name, request in sorted(build_requests(settings.SLACK_VERIFICATION_TOKEN).items()):
+        # Queries are counted on a short run, the query log is bounded
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(1000):
+                handler.handle(request)
+
+        start = time.time()
+        for i in range(args.events):
+            handler.handle(request)
+        elapsed = time.time() - start
+
+        results[name] = {
+            'events_per_second': args.events / elapsed,
+            'queries_per_event': len(queries) / 1000.0,
+        }
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
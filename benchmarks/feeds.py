@@ -0,0 +1,143 @@
+"""
+Compares the throughput of the feed serializer, which joins the messages'
+pre-encoded fragments, with the RequestFactory round-trip ChatJson.as_string
+used to go through and with encoding every message.
+
+    $ python -m benchmarks.feeds --messages 20000
+"""
+import argparse
+import json
+import time
+from benchmarks import setup
+
+
+def populate(messages):
+    from chat.models import ChatChannel, ChatMessage, ChatUser
+
+    ChatMessage.objects.all().delete()
+    ChatChannel.objects.all().delete()
+    ChatUser.objects.all().delete()
+
+    users = [
+        ChatUser.objects.create(user_id='UBENCH%02d' % i, name='user%s' % i, real_name='User %s' % i)
+        for i in range(20)
+    ]
+    # bulk_create skips ChatChannel.save, which would post to Slack
+    ChatChannel.objects.bulk_create([
+        ChatChannel(channel_id='CBENCH', slug='benchmark', headline='Benchmark')
+    ])
+    channel = ChatChannel.objects.get(channel_id='CBENCH')
+
+    batch = []
+    for i in range(messages):
+        ts = '%d.%06d' % (1500000000 + i, i % 1000)
+        message = ChatMessage(
+            ts=ts,
+            data=json.dumps({'ts': ts, 'text': 'Message %s' % i}),
+            html=u'<p>Message %s with some <b>formatting</b> and \xe9</p>' % i,
+            user=users[i % len(users)],
+            channel=channel,
+        )
+        message.update_feed_json()
+        batch.append(message)
+    ChatMessage.objects.bulk_create(batch)
+    return channel
+
+
+def get_legacy_view():
+    """
+    Returns ChatJson as it was before the feed serializer, building a fake
+    request and a JsonResponse to get the feed as a string.
+    """
+    from django.http import JsonResponse
+    from django.test.client import RequestFactory
+    from chat.models import ChatChannel, ChatMessage
+    from chat.serializers import serialize_channel, serialize_message
+    from chat.views import ChatJson
+
+    class LegacyChatJson(ChatJson):
+        @classmethod
+        def legacy_as_string(cls, object):
+            request = RequestFactory().get('')
+            response = cls.as_view()(request, channel=object.channel_id)
+            return response.content
+
+        def get_chat_messages(self, channel):
+            self.channel = ChatChannel.objects.get(channel_id=channel)
+            self.messages = ChatMessage.messages.live().filter(
+                channel=self.channel
+            ).select_related('user')
+            return True
+
+        def get_json(self):
+            return JsonResponse({
+                'channel': serialize_channel(self.channel),
+                'messages': [serialize_message(message) for message in self.messages],
+                'next_cursor': self.next_cursor,
+            })
+
+    return LegacyChatJson
+
+
+def measure(render, rounds):
+    """
+    Returns the best time of a few rounds and the size of the output.
+    """
+    best = None
+    for i in range(rounds):
+        start = time.time()
+        content = render()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'seconds': best,
+        'bytes': len(content),
+        'mb_per_sec': len(content) / best / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--database', help="SQLite file to use, kept between runs.")
+    args = parser.parse_args()
+
+    setup(args.database)
+    from chat import publisher
+    from chat.models import ChatMessage
+    from chat.serializers import dumps_jsonp, serialize_message
+    from chat.views import ChatJson
+
+    channel = populate(args.messages)
+    LegacyChatJson = get_legacy_view()
+    feed = publisher.load_feed(channel)
+    # The message dicts the publisher used to keep and encode on every write
+    message_dicts = [
+        serialize_message(message)
+        for message in ChatMessage.messages.live().filter(channel=channel).select_related('user')
+    ]
+
+    results = [
+        ('as_string, RequestFactory round-trip', lambda: LegacyChatJson.legacy_as_string(channel)),
+        ('as_string, feed serializer', lambda: ChatJson.as_string(channel)),
+        ('publisher, encoding every message', lambda: publisher.to_jsonp({
+            'channel': feed.channel,
+            'messages': message_dicts,
+        })),
+        ('publisher, feed serializer', lambda: dumps_jsonp(feed.channel, feed.iter_messages())),
+    ]
+
+    print '%s messages, best of %s rounds' % (args.messages, args.rounds)
+    for name, render in results:
+        result = measure(render, args.rounds)
+        print '%-40s %8.1fms %10d bytes %8.1f MB/s' % (
+            name,
+            result['seconds'] * 1000,
+            result['bytes'],
+            result['mb_per_sec']
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""
+Drives a synthetic Slack event load through SlackEventWebhook and reports the
+throughput, acknowledgement latency, publish lag and queries per event.
+
+    $ python -m benchmarks.load --events 5000 --rate 200 --concurrency 4
+    $ python -m benchmarks.load --output before.json
+    $ python -m benchmarks.load --compare before.json
+
+Events are posted with the Django test client, so the whole request path
+runs but no HTTP server is involved. The tasks run in the configured task
+backend and the run waits for them and for the pending publishes before
+reporting.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from Queue import Queue
+from benchmarks import setup, summarize
+
+TOKEN = 'benchmark'
+
+# Share of each kind of event in the generated load
+DEFAULT_MIX = {
+    'message': 50,
+    'mention': 15,
+    'edit': 10,
+    'delete': 5,
+    'comment': 5,
+    'unlogged': 15,
+}
+
+
+class EventGenerator(object):
+    """
+    Generates Slack Events API payloads. Edits and deletes refer to
+    messages generated earlier so they hit existing rows.
+    """
+    def __init__(self, channels=5, unlogged_channels=20, users=50, mix=None, seed=0):
+        self.channel_ids = ['CLOAD%04d' % i for i in range(channels)]
+        self.unlogged_channel_ids = ['CUNLOGGED%04d' % i for i in range(unlogged_channels)]
+        self.user_ids = ['ULOAD%04d' % i for i in range(users)]
+        self.random = random.Random(seed)
+        self.sent = dict((channel_id, []) for channel_id in self.channel_ids)
+        self.count = 0
+
+        mix = mix or DEFAULT_MIX
+        self.kinds = []
+        for kind, weight in sorted(mix.items()):
+            self.kinds.extend([kind] * weight)
+
+    def next_ts(self):
+        self.count += 1
+        return '%d.%06d' % (1500000000 + self.count // 1000000, self.count % 1000000)
+
+    def text(self, mentions=0):
+        words = ['lorem', 'ipsum', '*dolor*', 'sit', '_amet_', 'consectetur', '`code`', 'elit']
+        text = ' '.join(self.random.choice(words) for i in range(self.random.randint(3, 30)))
+        for i in range(mentions):
+            text += ' <@%s>' % self.random.choice(self.user_ids)
+        return text
+
+    def payload(self, event):
+        return {
+            'token': TOKEN,
+            'type': 'event_callback',
+            'event_id': 'EvLOAD%08d' % self.count,
+            'event': event,
+        }
+
+    def message(self, channel_id, text):
+        ts = self.next_ts()
+        event = {
+            'type': 'message',
+            'channel': channel_id,
+            'user': self.random.choice(self.user_ids),
+            'text': text,
+            'ts': ts,
+        }
+        if channel_id in self.sent:
+            self.sent[channel_id].append(ts)
+        return event
+
+    def generate(self):
+        """
+        Returns the kind and payload of the next event.
+        """
+        kind = self.random.choice(self.kinds)
+        channel_id = self.random.choice(self.channel_ids)
+        sent = self.sent[channel_id]
+
+        if kind in ('edit', 'delete') and not sent:
+            kind = 'message'
+
+        if kind == 'message':
+            event = self.message(channel_id, self.text())
+        elif kind == 'mention':
+            event = self.message(channel_id, self.text(mentions=self.random.randint(1, 3)))
+        elif kind == 'comment':
+            event = self.message(channel_id, '&lt;#&gt; ' + self.text())
+        elif kind == 'unlogged':
+            event = self.message(self.random.choice(self.unlogged_channel_ids), self.text())
+        elif kind == 'edit':
+            ts = self.random.choice(sent)
+            event = {
+                'type': 'message',
+                'subtype': 'message_changed',
+                'channel': channel_id,
+                'message': {
+                    'type': 'message',
+                    'user': self.random.choice(self.user_ids),
+                    'text': self.text(mentions=self.random.randint(0, 1)),
+                    'ts': ts,
+                },
+                'ts': self.next_ts(),
+            }
+        else:
+            ts = sent.pop(self.random.randrange(len(sent)))
+            event = {
+                'type': 'message',
+                'subtype': 'message_deleted',
+                'channel': channel_id,
+                'deleted_ts': ts,
+                'ts': self.next_ts(),
+            }
+        return kind, self.payload(event)
+
+
+def populate(generator):
+    """
+    Creates the logged channels and the users of the generated events.
+    """
+    from chat.models import ChatChannel, ChatMessage, ChatUser
+
+    ChatMessage.objects.all().delete()
+    ChatChannel.objects.all().delete()
+    ChatUser.objects.all().delete()
+
+    # bulk_create skips ChatChannel.save, which would post to Slack
+    ChatChannel.objects.bulk_create([
+        ChatChannel(channel_id=channel_id, slug=channel_id.lower(), headline='Load %s' % channel_id)
+        for channel_id in generator.channel_ids
+    ])
+    ChatUser.objects.bulk_create([
+        ChatUser(user_id=user_id, name=user_id.lower(), real_name='User %s' % user_id)
+        for user_id in generator.user_ids
+    ])
+
+
+def drive(events, rate, concurrency):
+    """
+    Posts the events from `concurrency` threads, starting each one at most
+    `rate` per second if a rate is given. Returns the latency of each
+    event by kind, the number of failed requests and the elapsed time.
+    """
+    from django.core.urlresolvers import reverse
+    from django.db import connection
+    from django.test import Client
+
+    url = reverse('slack-event-webhook')
+    queue = Queue()
+    for event in events:
+        queue.put(event)
+    for i in range(concurrency):
+        queue.put(None)
+
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    start = time.time()
+
+    def worker():
+        client = Client()
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                index, kind, payload = item
+                if rate:
+                    delay = start + float(index) / rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                sent = time.time()
+                response = client.post(url, json.dumps(payload), content_type='application/json')
+                latency = time.time() - sent
+                with lock:
+                    latencies.append((kind, latency))
+                    if response.status_code != 200:
+                        failures.append(response.status_code)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, failures, time.time() - start
+
+
+def histogram_stats(name):
+    """
+    Returns the count, mean and approximate median and 99th percentile of
+    a histogram of the metrics registry, summed over its labels. The
+    percentiles are the upper bounds of the buckets they fall in.
+    """
+    from chat.metrics import registry
+    histogram = registry.metrics.get(name)
+    if histogram is None or not histogram.values:
+        return None
+
+    bucket_counts = [0] * (len(histogram.buckets) + 1)
+    total = 0
+    count = 0
+    for buckets, value_sum, value_count in histogram.values.values():
+        bucket_counts = [a + b for a, b in zip(bucket_counts, buckets)]
+        total += value_sum
+        count += value_count
+
+    def quantile(q):
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets + (float('inf'),), bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= q * count:
+                return bound
+    return {
+        'count': count,
+        'sum': total,
+        'mean': float(total) / count,
+        'p50_le': quantile(0.5),
+        'p99_le': quantile(0.99),
+    }
+
+
+def run(args):
+    from django.conf import settings
+    from chat import workers
+    from chat.scheduler import scheduler
+
+    settings.SLACK_VERIFICATION_TOKEN = TOKEN
+    settings.ALLOWED_HOSTS = ['testserver']
+    settings.CHAT_TASK_BACKEND = args.task_backend
+    settings.CHAT_METRICS_COUNT_QUERIES = True
+
+    generator = EventGenerator(
+        channels=args.channels,
+        unlogged_channels=args.unlogged_channels,
+        users=args.users,
+        seed=args.seed
+    )
+    populate(generator)
+    events = [(i,) + generator.generate() for i in range(args.events)]
+
+    latencies, failures, elapsed = drive(events, args.rate, args.concurrency)
+
+    # Wait for the queued tasks and the pending publishes
+    drain_start = time.time()
+    workers.get_backend().shutdown()
+    scheduler.flush_all()
+    drain = time.time() - drain_start
+
+    kinds = {}
+    for kind, latency in latencies:
+        kinds.setdefault(kind, []).append(latency)
+
+    event_queries = histogram_stats('chat_event_queries')
+    task_queries = histogram_stats('chat_task_queries')
+    queries = (event_queries['sum'] if event_queries else 0) + (task_queries['sum'] if task_queries else 0)
+
+    from django.db import connection
+    return {
+        'config': {
+            'events': args.events,
+            'rate': args.rate,
+            'concurrency': args.concurrency,
+            'channels': args.channels,
+            'unlogged_channels': args.unlogged_channels,
+            'users': args.users,
+            'seed': args.seed,
+            'task_backend': args.task_backend,
+            'database': connection.vendor,
+        },
+        'elapsed_seconds': elapsed,
+        'drain_seconds': drain,
+        'events_per_second': len(latencies) / elapsed,
+        'failures': len(failures),
+        'ack_latency': summarize([latency for kind, latency in latencies]),
+        'ack_latency_by_kind': dict((kind, summarize(values)) for kind, values in kinds.items()),
+        'queries_per_event': float(queries) / len(latencies),
+        'publish_lag_seconds': histogram_stats('chat_publish_lag_seconds'),
+        'task_seconds': histogram_stats('chat_task_seconds'),
+    }
+
+
+def compare(report, baseline):
+    """
+    Prints the change of the main figures since a previous report.
+    """
+    figures = [
+        ('events/s', lambda r: r['events_per_second']),
+        ('ack p50 ms', lambda r: r['ack_latency']['p50_ms']),
+        ('ack p99 ms', lambda r: r['ack_latency']['p99_ms']),
+        ('queries/event', lambda r: r['queries_per_event']),
+        ('publish lag mean s', lambda r: (r['publish_lag_seconds'] or {}).get('mean')),
+    ]
+    print '%-20s %12s %12s %8s' % ('', 'baseline', 'current', 'change')
+    for name, get in figures:
+        before, after = get(baseline), get(report)
+        if before is None or after is None:
+            continue
+        change = '%+.1f%%' % (100.0 * (after - before) / before) if before else ''
+        print '%-20s %12.3f %12.3f %8s' % (name, before, after, change)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=0, help="Events per second, 0 for as fast as possible.")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of threads posting events.")
+    parser.add_argument('--channels', type=int, default=5, help="Number of logged channels.")
+    parser.add_argument('--unlogged-channels', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--task-backend', default='chat.workers.ThreadBackend')
+    parser.add_argument('--database', help="SQLite file to use.")
+    parser.add_argument('--postgres', help="Name of a local PostgreSQL database to use instead of SQLite.")
+    parser.add_argument('--output', help="Save the report to this JSON file.")
+    parser.add_argument('--compare', help="A previous JSON report to compare with.")
+    args = parser.parse_args()
+
+    setup(args.database, args.postgres)
+    report = run(args)
+
+    print json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Measures the latency of the ChatMessage lookups used when a message is
+edited or deleted and when a feed is rendered.
+
+    $ python -m benchmarks.lookups --rows 1000000
+"""
+import argparse
+import json
+import random
+import time
+from benchmarks import setup, summarize
+
+
+def populate(rows, channels):
+    """
+    Fills the database with `rows` messages spread over `channels` channels.
+    """
+    from chat.models import ChatChannel, ChatMessage, ChatUser
+
+    ChatMessage.objects.all().delete()
+    ChatChannel.objects.all().delete()
+    ChatUser.objects.all().delete()
+
+    user = ChatUser.objects.create(user_id='UBENCHMARK', name='benchmark')
+    ChatChannel.objects.bulk_create([
+        ChatChannel(channel_id='CBENCH%04d' % i, slug='benchmark-%s' % i, headline='Benchmark')
+        for i in range(channels)
+    ])
+    channel_ids = list(ChatChannel.objects.values_list('pk', flat=True))
+
+    batch = []
+    for i in range(rows):
+        ts = '%d.%06d' % (1500000000 + i // 1000, i % 1000)
+        batch.append(ChatMessage(
+            ts=ts,
+            data=json.dumps({'ts': ts, 'text': 'Message %s' % i}),
+            html='<p>Message %s</p>' % i,
+            live=i % 10 != 0,
+            user_id=user.pk,
+            channel_id=channel_ids[i % channels],
+        ))
+        if len(batch) == 10000:
+            ChatMessage.objects.bulk_create(batch)
+            batch = []
+    ChatMessage.objects.bulk_create(batch)
+
+
+def time_lookups(lookup, samples):
+    timings = []
+    for args in samples:
+        start = time.time()
+        lookup(*args)
+        timings.append(time.time() - start)
+    return summarize(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--lookups', type=int, default=200)
+    parser.add_argument('--database', help="SQLite file to use, kept between runs.")
+    parser.add_argument('--reuse', action='store_true', help="Don't repopulate the database.")
+    args = parser.parse_args()
+
+    setup(args.database)
+    from chat.models import ChatMessage
+
+    if not args.reuse:
+        start = time.time()
+        populate(args.rows, args.channels)
+        print 'Populated %s messages in %.1fs' % (args.rows, time.time() - start)
+
+    samples = random.sample(
+        list(ChatMessage.objects.values_list('channel__channel_id', 'ts')[:100000]),
+        args.lookups
+    )
+
+    results = {
+        # The unscoped lookup used before messages were unique per channel
+        'get_by_ts': time_lookups(
+            lambda channel_id, ts: list(ChatMessage.objects.filter(ts=ts)),
+            samples
+        ),
+        'get_by_channel_and_ts': time_lookups(
+            lambda channel_id, ts: ChatMessage.objects.get(channel__channel_id=channel_id, ts=ts),
+            samples
+        ),
+        'live_feed_page': time_lookups(
+            lambda channel_id, ts: list(
+                ChatMessage.messages.feed().filter(channel__channel_id=channel_id)[:50]
+            ),
+            samples
+        ),
+    }
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
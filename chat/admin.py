@@ -19,11 +19,34 @@ class ChatChannelAdmin(admin.ModelAdmin):
         'channel_id',
         'headline',
         'slug',
+        'archived',
     )
+    list_filter = ('archived',)
     search_fields = ('headline', 'slug', 'channel_id')
+    actions = ['archive', 'unarchive']
 
     save_on_top = True
 
+    def get_readonly_fields(self, request, obj=None):
+        # Archived channels are frozen, unarchive them to make changes
+        if obj and obj.archived:
+            return ('headline', 'slug', 'channel_id', 'description', 'live_content')
+        return super(ChatChannelAdmin, self).get_readonly_fields(request, obj)
+
+    def archive(self, request, queryset):
+        channels = queryset.filter(archived=False)
+        for channel in channels:
+            channel.archive()
+        self.message_user(request, "Archived %s channels." % len(channels))
+    archive.short_description = "Archive the selected channels"
+
+    def unarchive(self, request, queryset):
+        channels = queryset.filter(archived=True)
+        for channel in channels:
+            channel.unarchive()
+        self.message_user(request, "Unarchived %s channels." % len(channels))
+    unarchive.short_description = "Unarchive the selected channels"
+
 
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
@@ -0,0 +1,172 @@
+"""
+Fan-out of the channel feed changes to the clients of the live stream.
+
+Every change applied to a channel's feed is published to the broker, which
+hands it to each connected client of that channel and keeps a short history
+so reconnecting clients can resume from the last event they received. When
+the changes are applied in other processes, like with the ProcessBackend,
+a cross-process backend such as RedisBrokerBackend relays them.
+"""
+import collections
+import json
+import logging
+import threading
+from Queue import Empty, Full, Queue
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+class TooManyClients(Exception):
+    """
+    Raised when a process already streams to as many clients as it can.
+    """
+
+
+class Subscription(object):
+    """
+    The bounded queue of events waiting to be sent to a client.
+    """
+    def __init__(self, channel_id, size):
+        self.channel_id = channel_id
+        self.queue = Queue(maxsize=size)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            # The client is too slow, it will reconnect and resume instead
+            self.overflowed = True
+
+    def get(self, timeout):
+        """
+        Returns the next event, or None if none arrived before the timeout.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class Broker(object):
+    """
+    Relays events to the subscriptions of a channel in this process.
+    """
+    def __init__(self, history_size, client_queue_size, max_clients=None):
+        self.history_size = history_size
+        self.client_queue_size = client_queue_size
+        self.max_clients = max_clients
+        self.clients = 0
+        self.subscriptions = collections.defaultdict(set)
+        self.history = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.history_size)
+        )
+        self.lock = threading.Lock()
+        self.backend = None
+
+    def publish(self, channel_id, event):
+        """
+        Publishes an event to every process through the backend if
+        there is one, or to this process otherwise.
+        """
+        if self.backend is not None:
+            self.backend.publish(channel_id, event)
+        else:
+            self.dispatch(channel_id, event)
+
+    def dispatch(self, channel_id, event):
+        """
+        Hands an event to the subscriptions of this process.
+        """
+        with self.lock:
+            self.history[channel_id].append(event)
+            subscriptions = list(self.subscriptions[channel_id])
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def subscribe(self, channel_id, last_event_id=None):
+        """
+        Returns a new subscription to a channel and the events it missed
+        since `last_event_id`, or None if the history doesn't go back
+        that far and the client should reload the whole feed. Raises
+        TooManyClients if `max_clients` are already subscribed.
+        """
+        subscription = Subscription(channel_id, self.client_queue_size)
+        with self.lock:
+            if self.max_clients is not None and self.clients >= self.max_clients:
+                raise TooManyClients()
+            self.subscriptions[channel_id].add(subscription)
+            self.clients += 1
+            history = list(self.history.get(channel_id, []))
+
+        if last_event_id is None:
+            return subscription, []
+        if not history or float(history[0]['ts']) > float(last_event_id):
+            return subscription, None
+        return subscription, [e for e in history if float(e['ts']) > float(last_event_id)]
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions[subscription.channel_id]
+            if subscription in subscriptions:
+                subscriptions.discard(subscription)
+                self.clients -= 1
+
+
+class RedisBrokerBackend(object):
+    """
+    Relays the events between processes through Redis pub/sub.
+    """
+    def __init__(self, broker, url='redis://localhost:6379/0', prefix='chat:'):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured('RedisBrokerBackend requires the redis package.')
+
+        self.broker = broker
+        self.prefix = prefix
+        self.client = redis.StrictRedis.from_url(url)
+
+        thread = threading.Thread(target=self.listen, name='chat-broker')
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, channel_id, event):
+        self.client.publish(self.prefix + channel_id, json.dumps(event, cls=DjangoJSONEncoder))
+
+    def listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(self.prefix + '*')
+        for message in pubsub.listen():
+            try:
+                channel_id = message['channel'][len(self.prefix):]
+                self.broker.dispatch(channel_id, json.loads(message['data']))
+            except Exception:
+                logger.exception('Could not relay a broker message.')
+
+
+def get_broker():
+    """
+    Returns the broker of this process, starting its backend on first use.
+    """
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                broker = Broker(
+                    settings.CHAT_STREAM_HISTORY_SIZE,
+                    settings.CHAT_STREAM_CLIENT_QUEUE_SIZE,
+                    settings.CHAT_STREAM_MAX_CLIENTS
+                )
+                if settings.CHAT_STREAM_BACKEND:
+                    backend_class = import_string(settings.CHAT_STREAM_BACKEND)
+                    broker.backend = backend_class(broker, **settings.CHAT_STREAM_BACKEND_OPTIONS)
+                _broker = broker
+    return _broker
@@ -0,0 +1,51 @@
+"""
+Precompressed variants of the published feed files.
+
+Each file is compressed once when it's published, and the JSON route picks
+the variant matching the reader's Accept-Encoding header. Brotli is used
+when the optional `brotli` package is installed.
+"""
+import gzip
+from io import BytesIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def gzip_compress(content):
+    buf = BytesIO()
+    # A fixed mtime keeps the output identical for identical content
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+# (content encoding, file extension, compress function), most preferred first
+ENCODINGS = [
+    ('gzip', 'gz', gzip_compress),
+]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', 'br', brotli.compress))
+
+
+def get_accepted_encodings(request):
+    """
+    Returns the content encodings accepted by a request.
+    """
+    accepted = set()
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = item.split(';')
+        encoding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if encoding and quality > 0:
+            accepted.add(encoding)
+    return accepted
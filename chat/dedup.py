@@ -0,0 +1,109 @@
+"""
+Deduplication of the Slack events redelivered by the Events API.
+
+Slack retries an event when it isn't acknowledged fast enough, with the same
+`event_id`. Each id is remembered for `window` seconds so the retries can be
+acknowledged without doing the work again.
+"""
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class DedupStore(object):
+    """
+    Interface for the dedup stores, which also count the absorbed retries.
+    """
+    def __init__(self, window, size):
+        self.window = window
+        self.size = size
+        self.counts = {
+            'events': 0,
+            'duplicates': 0,
+            'retries': 0,
+            'retries_absorbed': 0,
+        }
+
+    def add(self, event_id):
+        """
+        Remembers an event id. Returns False if it was already seen.
+        """
+        raise NotImplementedError
+
+    def check(self, event_id, retry_num=None):
+        """
+        Returns True if the event should be handled, counting it.
+        """
+        is_new = self.add(event_id)
+        self.counts['events'] += 1
+        if retry_num is not None:
+            self.counts['retries'] += 1
+        if not is_new:
+            self.counts['duplicates'] += 1
+            if retry_num is not None:
+                self.counts['retries_absorbed'] += 1
+        return is_new
+
+    def stats(self):
+        return dict(self.counts)
+
+
+class MemoryDedupStore(DedupStore):
+    """
+    Remembers the ids in this process, at most `size` of them.
+    """
+    def __init__(self, window, size):
+        super(MemoryDedupStore, self).__init__(window, size)
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, event_id):
+        now = time.time()
+        with self.lock:
+            # Expire the ids older than the window, or over the size
+            while self.seen:
+                oldest_id = next(iter(self.seen))
+                if now - self.seen[oldest_id] <= self.window and len(self.seen) < self.size:
+                    break
+                del self.seen[oldest_id]
+
+            if event_id in self.seen:
+                return False
+            self.seen[event_id] = now
+            return True
+
+
+class CacheDedupStore(DedupStore):
+    """
+    Remembers the ids in a Django cache, shared between processes when the
+    cache is, like the database or memcached caches.
+    """
+    def __init__(self, window, size, alias='default'):
+        super(CacheDedupStore, self).__init__(window, size)
+        self.cache = caches[alias]
+
+    def add(self, event_id):
+        return self.cache.add('chat-event:%s' % event_id, 1, timeout=self.window)
+
+
+def get_store():
+    """
+    Returns the configured dedup store.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store_class = import_string(settings.CHAT_DEDUP_STORE)
+                _store = store_class(
+                    settings.CHAT_DEDUP_WINDOW,
+                    settings.CHAT_DEDUP_SIZE,
+                    **settings.CHAT_DEDUP_STORE_OPTIONS
+                )
+    return _store
@@ -0,0 +1,161 @@
+"""
+In-process caches of the Slack users, keyed by their Slack user id, and of
+the ids of the channels logged by this app.
+
+Users are looked up on every incoming message and every mention but only
+change a few times a day, when `updateusers` runs or a user is edited.
+Saves invalidate the cache of the process they happen in, the whole cache
+is reloaded every `timeout` seconds to pick up changes from other processes.
+Ids without a user, like mentions of users created since, are remembered
+for `miss_timeout` seconds so they don't cost a query every time.
+"""
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+
+class UserDirectory(object):
+    """
+    A bounded LRU cache of ChatUser objects.
+    """
+    def __init__(self, size, timeout, miss_timeout):
+        self.size = size
+        self.timeout = timeout
+        self.miss_timeout = miss_timeout
+        self.users = OrderedDict()
+        # The time until which each id without a user is known to be missing
+        self.missing = OrderedDict()
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """
+        Fills the cache with the users from the database in a single query.
+        """
+        from chat.models import ChatUser
+        users = list(ChatUser.objects.all()[:self.size])
+        with self.lock:
+            self.users.clear()
+            self.missing.clear()
+            for user in users:
+                self.users[user.user_id] = user
+            self.loaded_at = time.time()
+
+    def add(self, user):
+        with self.lock:
+            self.missing.pop(user.user_id, None)
+            self.users.pop(user.user_id, None)
+            self.users[user.user_id] = user
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+
+    def get_many(self, user_ids):
+        """
+        Returns a dict of the users found for the given ids, fetching
+        the ones that aren't cached in a single query.
+        """
+        from chat.models import ChatUser
+        if self.loaded_at is None or time.time() - self.loaded_at > self.timeout:
+            self.load()
+
+        found = {}
+        missing = []
+        now = time.time()
+        with self.lock:
+            for user_id in user_ids:
+                user = self.users.pop(user_id, None)
+                if user is not None:
+                    self.users[user_id] = user
+                    found[user_id] = user
+                elif self.missing.get(user_id, 0) <= now:
+                    missing.append(user_id)
+            self.hits += len(user_ids) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            for user in ChatUser.objects.filter(user_id__in=missing):
+                self.add(user)
+                found[user.user_id] = user
+            with self.lock:
+                for user_id in missing:
+                    if user_id not in found:
+                        self.missing.pop(user_id, None)
+                        self.missing[user_id] = now + self.miss_timeout
+                while len(self.missing) > self.size:
+                    self.missing.popitem(last=False)
+        return found
+
+    def get(self, user_id):
+        """
+        Returns the user with this id, or None if it doesn't exist.
+        """
+        return self.get_many([user_id]).get(user_id)
+
+    def get_or_create(self, user_id):
+        """
+        Returns the user with this id, creating it if it doesn't exist.
+        """
+        from chat.models import ChatUser
+        user = self.get(user_id)
+        if user is None:
+            user, created = ChatUser.objects.get_or_create(user_id=user_id)
+            self.add(user)
+        return user
+
+    def invalidate(self, user_id=None):
+        """
+        Drops a user, or every user, from the cache.
+        """
+        with self.lock:
+            if user_id is None:
+                self.users.clear()
+                self.missing.clear()
+                self.loaded_at = None
+            else:
+                self.users.pop(user_id, None)
+                self.missing.pop(user_id, None)
+
+    def stats(self):
+        return {
+            'size': len(self.users),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class ChannelDirectory(object):
+    """
+    The set of logged channel ids, so events from the other channels
+    can be ignored without a query. Archived channels aren't logged
+    anymore.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.channel_ids = frozenset()
+        self.loaded_at = None
+
+    def load(self):
+        from chat.models import ChatChannel
+        self.channel_ids = frozenset(
+            ChatChannel.objects.filter(archived=False).values_list('channel_id', flat=True)
+        )
+        self.loaded_at = time.time()
+
+    def is_logged(self, channel_id):
+        if self.loaded_at is None or time.time() - self.loaded_at > self.timeout:
+            self.load()
+        return channel_id in self.channel_ids
+
+    def invalidate(self):
+        self.loaded_at = None
+
+
+directory = UserDirectory(
+    settings.CHAT_USER_CACHE_SIZE,
+    settings.CHAT_USER_CACHE_TIMEOUT,
+    settings.CHAT_USER_CACHE_MISS_TIMEOUT
+)
+channels = ChannelDirectory(settings.CHAT_CHANNEL_CACHE_TIMEOUT)
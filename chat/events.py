@@ -1,11 +1,14 @@
 import json
+import metrics
 import tasks
 from django.conf import settings
-from models import ChatChannel
+from dedup import get_store
+from directory import channels
 from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 
 
 class SlackEventHandler(object):
+    @metrics.timed_function('chat_event')
     def handle(self, request):
         payload = self.parse_request(request)
         token = payload['token']
@@ -15,19 +18,23 @@ class SlackEventHandler(object):
 
         request_type = payload['type']
         if request_type == 'url_verification':
-            event_function = self.url_verification
+            return self.url_verification(payload)
         elif request_type == 'event_callback':
+            # Acknowledge the events Slack redelivers without handling them again
+            event_id = payload.get('event_id')
+            retry_num = request.META.get('HTTP_X_SLACK_RETRY_NUM')
+            if event_id and not get_store().check(event_id, retry_num):
+                return HttpResponse(status=200)
+
             event_name = payload['event']['type']
-            event_function_name = 'event_%s' % event_name
-            try:
-                event_function = getattr(self, event_function_name)
-            except AttributeError:
+            metrics.inc('chat_events_total', 'Slack events received.', type=event_name)
+            event_function = self.EVENTS.get(event_name)
+            if event_function is None:
                 return HttpResponse('SlackEventHandler: %s event does not exist.' % event_name, status=200)
+            return event_function(self, payload)
         else:
             return HttpResponse(status=400)
 
-        return event_function(payload)
-
     def parse_request(self, request):
         payload = json.loads(request.body)
         return payload
@@ -48,34 +55,42 @@ class SlackEventHandler(object):
     def event_message(self, payload):
         data = payload['event']
         channel_id = data['channel']
-        channel = ChatChannel.objects.filter(channel_id=channel_id)
-
-        if channel:
-            channel = channel[0]
-            subtype = data.get('subtype', None)
-            if subtype:
-                subtype_function_name = 'message_%s' % subtype
-                try:
-                    subtype_function = getattr(self, subtype_function_name)
-                except AttributeError:
-                    return HttpResponse(
-                        'SlackEventHandler: %s event message subtype does not exist.' % subtype,
-                        status=200
-                    )
-                return subtype_function(channel, data)
-            else:
-                return self.message_message_added(channel, data)
 
+        # Most messages come from channels that aren't logged,
+        # check the cached ids before touching the database
+        if not channels.is_logged(channel_id):
+            return HttpResponse(status=200)
+
+        subtype = data.get('subtype', None)
+        subtype_function = self.MESSAGE_SUBTYPES.get(subtype)
+        if subtype_function is None:
+            return HttpResponse(
+                'SlackEventHandler: %s event message subtype does not exist.' % subtype,
+                status=200
+            )
+        return subtype_function(self, channel_id, data)
+
+    def message_message_added(self, channel_id, data):
+        tasks.new_message.delay(channel_id, data)
         return HttpResponse(status=200)
 
-    def message_message_added(self, channel, data):
-        tasks.new_message(channel, data)
+    def message_message_changed(self, channel_id, data):
+        tasks.update_message.delay(channel_id, data)
         return HttpResponse(status=200)
 
-    def message_message_changed(self, channel, data):
-        tasks.update_message(data)
+    def message_message_deleted(self, channel_id, data):
+        tasks.delete_message.delay(channel_id, data)
         return HttpResponse(status=200)
 
-    def message_message_deleted(self, channel, data):
-        tasks.delete_message(data)
-        return HttpResponse(status=200)
+    # Handlers by event type
+    EVENTS = {
+        'message': event_message,
+    }
+
+    # Handlers by message subtype, plain messages have no subtype
+    MESSAGE_SUBTYPES = {
+        None: message_message_added,
+        'message_added': message_message_added,
+        'message_changed': message_message_changed,
+        'message_deleted': message_message_deleted,
+    }
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import ChatChannel
+
+
+class Command(BaseCommand):
+    help = "Archives finished channels, freezing their feed into a final snapshot"
+
+    def add_arguments(self, parser):
+        """
+        Adds custom arguments specific to this command.
+        """
+        parser.add_argument(
+            'channel_ids',
+            nargs='+',
+            help="Ids of the channels to archive."
+        )
+        parser.add_argument(
+            '--unarchive',
+            action="store_true",
+            help="Record the events of the channels again instead."
+        )
+
+    def handle(self, *args, **options):
+        channels = list(ChatChannel.objects.filter(channel_id__in=options['channel_ids']))
+        missing = set(options['channel_ids']) - set(c.channel_id for c in channels)
+        if missing:
+            raise CommandError('Not logged channels: %s' % ', '.join(sorted(missing)))
+
+        for channel in channels:
+            if options['unarchive']:
+                if channel.archived:
+                    channel.unarchive()
+                print 'Unarchived %s.' % channel.channel_id
+            else:
+                if not channel.archived:
+                    channel.archive()
+                print 'Archived %s as %s.' % (channel.channel_id, channel.snapshot)
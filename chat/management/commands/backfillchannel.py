@@ -0,0 +1,221 @@
+import json
+import time
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from chat import render, tasks
+from chat.directory import directory
+from chat.models import ChatChannel, ChatMessage, ChatUser
+from chat.slack import get_client
+
+# Put on the queue by a fetcher once a channel has no more pages
+DONE = object()
+
+
+class Command(BaseCommand):
+    help = "Imports the message history of logged channels from Slack"
+
+    def add_arguments(self, parser):
+        """
+        Adds custom arguments specific to this command.
+        """
+        parser.add_argument(
+            'channel_ids',
+            nargs='*',
+            help="Ids of the channels to backfill."
+        )
+        parser.add_argument(
+            '--all',
+            action="store_true",
+            help="Backfill every logged channel."
+        )
+        parser.add_argument(
+            '--oldest',
+            help="Only import messages after this ts."
+        )
+        parser.add_argument(
+            '--latest',
+            help="Only import messages before this ts."
+        )
+        parser.add_argument(
+            '--page-size',
+            type=int,
+            default=200,
+            help="Number of messages requested from Slack per page."
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help="Number of channels fetched at the same time."
+        )
+        parser.add_argument(
+            '--verbose',
+            action="store_true",
+            help="Print out a progress log."
+        )
+
+    def log_progress(self, msg):
+        if self.verbose:
+            print msg
+
+    def fetch(self, channel_id, pages, options):
+        """
+        Pages through the history of a channel, putting each page on the
+        queue. Runs in a thread, the rate limit is shared by all of them.
+        """
+        sc = get_client()
+        cursor = None
+        try:
+            while True:
+                response = sc.api_call(
+                    'conversations.history',
+                    channel=channel_id,
+                    limit=options['page_size'],
+                    cursor=cursor,
+                    oldest=options['oldest'],
+                    latest=options['latest']
+                )
+                if not response.get('ok'):
+                    pages.put((channel_id, CommandError(
+                        'conversations.history failed for %s: %s' % (channel_id, response.get('error'))
+                    )))
+                    return
+
+                pages.put((channel_id, response['messages']))
+
+                cursor = response.get('response_metadata', {}).get('next_cursor') or None
+                if not response.get('has_more') or not cursor:
+                    return
+        except Exception as e:
+            pages.put((channel_id, e))
+        finally:
+            pages.put((channel_id, DONE))
+
+    def exclude_existing(self, channel, messages, get_ts):
+        """
+        Returns the messages whose ts isn't in the database yet.
+        """
+        existing = set(ChatMessage.objects.filter(
+            channel=channel,
+            ts__in=[get_ts(m) for m in messages]
+        ).values_list('ts', flat=True))
+        return [m for m in messages if get_ts(m) not in existing]
+
+    def build_messages(self, channel, messages):
+        """
+        Returns the rendered ChatMessages of a page's Slack messages.
+        """
+        # Read from the database rather than from the directory, which can
+        # be stale, as the author's names are stored in feed_json
+        user_ids = set(m['user'] for m in messages)
+        users = dict(
+            (user.user_id, user)
+            for user in ChatUser.objects.filter(user_id__in=user_ids).only('user_id', *ChatUser.FEED_FIELDS)
+        )
+        for user_id in user_ids - set(users):
+            users[user_id] = directory.get_or_create(user_id)
+
+        sources = [json.dumps(m) for m in messages]
+        new_messages = []
+        for data, source, (html, key) in zip(messages, sources, render.render_many(sources)):
+            message = ChatMessage(
+                ts=data['ts'],
+                data=source,
+                user=users[data['user']],
+                channel=channel,
+                html=html,
+                html_hash=key,
+            )
+            message.update_feed_json()
+            new_messages.append(message)
+        return new_messages
+
+    def save_page(self, channel, messages):
+        """
+        Renders and inserts the new messages of a page in bulk. Returns the
+        number of messages inserted.
+        """
+        # The same messages new_message would record
+        messages = [
+            m for m in messages
+            if m.get('user') and not m.get('subtype') and not tasks.is_comment(m)
+        ]
+        messages = self.exclude_existing(channel, messages, lambda m: m['ts'])
+        if not messages:
+            return 0
+
+        new_messages = self.build_messages(channel, messages)
+        while True:
+            try:
+                with transaction.atomic():
+                    ChatMessage.objects.bulk_create(new_messages)
+                break
+            except IntegrityError:
+                # The live events inserted some of them in the meantime
+                remaining = self.exclude_existing(channel, new_messages, lambda m: m.ts)
+                if len(remaining) == len(new_messages):
+                    raise
+                new_messages = remaining
+                if not new_messages:
+                    return 0
+
+        # Processes with the channel's feed cached reload it on their next change
+        channel.touch()
+        return len(new_messages)
+
+    def handle(self, *args, **options):
+        self.verbose = options['verbose']
+
+        if options['all']:
+            channels = list(ChatChannel.objects.filter(archived=False))
+        else:
+            channels = list(ChatChannel.objects.filter(channel_id__in=options['channel_ids']))
+            missing = set(options['channel_ids']) - set(c.channel_id for c in channels)
+            if missing:
+                raise CommandError('Not logged channels: %s' % ', '.join(sorted(missing)))
+            archived = [c.channel_id for c in channels if c.archived]
+            if archived:
+                raise CommandError('Archived channels: %s' % ', '.join(sorted(archived)))
+        if not channels:
+            raise CommandError('Give the ids of the channels to backfill, or --all.')
+        channels = dict((c.channel_id, c) for c in channels)
+
+        start = time.time()
+        pages = Queue(maxsize=options['workers'] * 2)
+        pool = ThreadPool(options['workers'])
+        for channel_id in channels:
+            pool.apply_async(self.fetch, (channel_id, pages, options))
+        pool.close()
+
+        # Pages are saved from this thread as the fetchers deliver them
+        counts = dict((channel_id, 0) for channel_id in channels)
+        errors = []
+        remaining = len(channels)
+        while remaining:
+            channel_id, page = pages.get()
+            if page is DONE:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                errors.append(page)
+            else:
+                counts[channel_id] += self.save_page(channels[channel_id], page)
+                self.log_progress('%s: %s messages imported' % (channel_id, counts[channel_id]))
+        pool.join()
+
+        # A single publish per channel once everything is in
+        for channel_id, channel in channels.items():
+            if counts[channel_id]:
+                tasks.publish_json(channel_id)
+
+        elapsed = time.time() - start
+        total = sum(counts.values())
+        print 'Imported %s messages from %s channels in %.2fs (%.0f messages/s).' % (
+            total,
+            len(channels),
+            elapsed,
+            total / elapsed if elapsed else 0
+        )
+        if errors:
+            raise CommandError('\n'.join(str(e) for e in errors))
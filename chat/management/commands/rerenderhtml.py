@@ -0,0 +1,187 @@
+import time
+from collections import deque
+from multiprocessing import Pool
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from chat import render, tasks
+from chat.directory import directory
+from chat.models import ChatChannel, ChatMessage
+from chat.utils import bulk_update
+
+
+def render_sources(items):
+    """
+    Renders a list of (source, names) pairs. Runs in the worker
+    processes, so it must not touch the database.
+    """
+    return [render.render(source, names) for source, names in items]
+
+
+class Command(BaseCommand):
+    help = "Renders the HTML of the messages again and republishes their channels"
+
+    def add_arguments(self, parser):
+        """
+        Adds custom arguments specific to this command.
+        """
+        parser.add_argument(
+            'channel_ids',
+            nargs='*',
+            help="Only render the messages of these channels. Archived channels are skipped."
+        )
+        parser.add_argument(
+            '--force',
+            action="store_true",
+            help="Render every message, even if its source and mentions didn't change."
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help="Number of rendering processes."
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="Number of messages read, rendered and saved at a time."
+        )
+        parser.add_argument(
+            '--verbose',
+            action="store_true",
+            help="Print out a progress log."
+        )
+
+    def log_progress(self, msg):
+        if self.verbose:
+            print msg
+
+    def iter_batches(self, queryset, batch_size):
+        """
+        Yields the messages in batches ordered by primary key. Each batch is
+        a query of its own, so no cursor is held open while saving.
+        """
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not batch:
+                return
+            last_pk = batch[-1].pk
+            yield batch
+
+    def prepare(self, batch, force):
+        """
+        Returns the messages of a batch that need to be rendered, with
+        their render keys and the (source, names) pairs to render.
+        """
+        sources = [render.get_source(m.data, m.override_text) for m in batch]
+        mentioned_ids = [render.get_mentioned_ids(source) for source in sources]
+        all_ids = set().union(*mentioned_ids)
+        users = directory.get_many(list(all_ids)) if all_ids else {}
+
+        stale = []
+        for message, source, user_ids in zip(batch, sources, mentioned_ids):
+            names = dict(
+                (user_id, users[user_id].display_name) for user_id in user_ids if user_id in users
+            )
+            key = render.get_render_key(source, names)
+            if force or key != message.html_hash:
+                stale.append((message, key, (source, names)))
+        return stale
+
+    def save(self, stale, rendered):
+        """
+        Saves the rendered messages of a batch. Messages edited since the
+        batch was read were rendered by their own save and are skipped.
+        """
+        with transaction.atomic():
+            sources = dict(
+                (pk, (data, override_text))
+                for pk, data, override_text in ChatMessage.objects.select_for_update().filter(
+                    pk__in=[message.pk for message, key, item in stale]
+                ).values_list('pk', 'data', 'override_text')
+            )
+            messages = []
+            for (message, key, item), html in zip(stale, rendered):
+                if sources.get(message.pk) != (message.data, message.override_text):
+                    continue
+                message.html = html
+                message.html_hash = key
+                message.update_feed_json()
+                messages.append(message)
+            if not messages:
+                return messages
+            bulk_update(messages, ['html', 'html_hash', 'feed_json'], batch_size=len(messages))
+
+            # Processes with these feeds cached reload them on their next change
+            ChatChannel.objects.filter(pk__in=set(m.channel_id for m in messages)).update(
+                version=F('version') + 1,
+                last_modified=timezone.now()
+            )
+        return messages
+
+    def handle(self, *args, **options):
+        self.verbose = options['verbose']
+
+        queryset = ChatMessage.objects.select_related('user').only(
+            'id',
+            'ts',
+            'channel',
+            'data',
+            'override_text',
+            'html_hash',
+            'user__name',
+            'user__real_name',
+            'user__image_48',
+        ).filter(channel__archived=False)
+        if options['channel_ids']:
+            queryset = queryset.filter(channel__channel_id__in=options['channel_ids'])
+
+        # Fork the workers before opening a connection they could inherit
+        connection.close()
+        pool = Pool(options['workers'])
+
+        start = time.time()
+        read = 0
+        rendered = 0
+        channel_pks = set()
+        pending = deque()
+        try:
+            for batch in self.iter_batches(queryset, options['batch_size']):
+                read += len(batch)
+                stale = self.prepare(batch, options['force'])
+                if stale:
+                    items = [item for message, key, item in stale]
+                    pending.append((stale, pool.apply_async(render_sources, (items,))))
+
+                # Keep every worker busy while the oldest batches are saved
+                while pending and (len(pending) > options['workers'] or pending[0][1].ready()):
+                    stale, result = pending.popleft()
+                    for message in self.save(stale, result.get()):
+                        channel_pks.add(message.channel_id)
+                    rendered += len(stale)
+                self.log_progress('%s messages read, %s rendered' % (read, rendered))
+
+            while pending:
+                stale, result = pending.popleft()
+                for message in self.save(stale, result.get()):
+                    channel_pks.add(message.channel_id)
+                rendered += len(stale)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        # A single publish per affected channel
+        for channel in ChatChannel.objects.filter(pk__in=channel_pks):
+            tasks.publish_json(channel.channel_id)
+
+        elapsed = time.time() - start
+        print 'Rendered %s of %s messages in %.2fs (%.0f messages/s), republished %s channels.' % (
+            rendered,
+            read,
+            elapsed,
+            read / elapsed if elapsed else 0,
+            len(channel_pks)
+        )
@@ -1,7 +1,13 @@
+import os
+import time
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from chat import tasks
+from chat.directory import directory
 from chat.models import ChatUser
-from slackclient import SlackClient
+from chat.slack import get_client
+from chat.utils import bulk_update, chunks
 
 
 class Command(BaseCommand):
@@ -27,64 +33,213 @@ class Command(BaseCommand):
             action="store_true",
             help="Don't print out a progress log."
         )
+        parser.add_argument(
+            '--bulk',
+            action="store_true",
+            help="Compare all users in memory and save the changes in bulk."
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="Number of users saved per query in bulk mode."
+        )
+        parser.add_argument(
+            '--page-size',
+            type=int,
+            default=200,
+            help="Number of users requested from Slack per page."
+        )
+        parser.add_argument(
+            '--resume',
+            action="store_true",
+            help="Continue from the last page saved by an interrupted run."
+        )
 
     def log_progress(self, msg):
         if self.verbose:
             print msg
 
+    def get_slack_value(self, slack_user, field):
+        """
+        Returns the value of a ChatUser field from the Slack API user data.
+        """
+        if field[:6] == 'image_':
+            return slack_user['profile'].get(field, None)
+        return slack_user.get(field, None)
+
+    def build_user(self, slack_user):
+        """
+        Returns a new ChatUser from the Slack API user data.
+        """
+        user_data = {
+            'user_id': slack_user['id'],
+        }
+        for field in self.UPDATE_FIELDS:
+            user_data[field] = self.get_slack_value(slack_user, field) or ''
+        return ChatUser(**user_data)
+
+    def update_user(self, db_user, slack_user):
+        """
+        Copies the changed fields of the Slack API user data onto the
+        ChatUser and returns the names of the fields that changed.
+        """
+        changed_fields = []
+        for field in self.UPDATE_FIELDS:
+            # Get the db value for the field
+            db_field = getattr(db_user, field)
+
+            # Get the slack API call value for the field
+            user_field = self.get_slack_value(slack_user, field)
+
+            # Compare the fields and update if different
+            if user_field and db_field != user_field:
+                self.log_progress('Change Found: Updating "%s" from "%s" to "%s" for user "%s"' % (
+                    field,
+                    db_field,
+                    user_field,
+                    slack_user['name']
+                ))
+                setattr(db_user, field, user_field)
+                changed_fields.append(field)
+        return changed_fields
+
+    def get_client(self):
+        return get_client()
+
+    def get_cursor_path(self):
+        return os.path.join(settings.ROOT_DIR, 'chat', '.updateusers_cursor')
+
+    def read_cursor(self):
+        """
+        Returns the cursor saved by an interrupted run, if any.
+        """
+        try:
+            with open(self.get_cursor_path()) as f:
+                return f.read().strip() or None
+        except IOError:
+            return None
+
+    def save_cursor(self, cursor):
+        """
+        Saves the cursor of the next page, or clears it once all pages are done.
+        """
+        path = self.get_cursor_path()
+        if cursor:
+            with open(path, 'w') as f:
+                f.write(cursor)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def iter_pages(self, sc, page_size, cursor=None):
+        """
+        Yields each page of users from the Slack API with the cursor
+        of the page that follows it.
+        """
+        while True:
+            response = sc.api_call('users.list', limit=page_size, cursor=cursor)
+            if not response.get('ok'):
+                raise CommandError('users.list failed: %s' % response.get('error'))
+
+            cursor = response.get('response_metadata', {}).get('next_cursor') or None
+            yield response['members'], cursor
+
+            if not cursor:
+                return
+
     def handle(self, *args, **kwds):
-        sc = SlackClient(settings.SLACK_BOT_TOKEN)
+        sc = self.get_client()
         self.verbose = kwds['verbose']
 
-        users = sc.api_call('users.list')['members']
+        cursor = self.read_cursor() if kwds['resume'] else None
+        if cursor:
+            self.log_progress('Resuming from cursor "%s".' % cursor)
+
+        start = time.time()
+        self.counts = {'added': 0, 'updated': 0, 'unchanged': 0}
+        for users, next_cursor in self.iter_pages(sc, kwds['page_size'], cursor):
+            with transaction.atomic():
+                if kwds['bulk']:
+                    self.sync_bulk(users, kwds['batch_size'])
+                else:
+                    self.sync(users)
+            self.save_cursor(next_cursor)
+
+        print 'Checked %s users in %.2fs: %s added, %s updated, %s unchanged.' % (
+            sum(self.counts.values()),
+            time.time() - start,
+            self.counts['added'],
+            self.counts['updated'],
+            self.counts['unchanged']
+        )
+
+        # Reload the user cache with the new data
+        directory.invalidate()
 
+    def sync(self, users):
+        """
+        Checks and saves each user one by one.
+        """
         for slack_user in users:
             slack_id = slack_user['id']
             self.log_progress('Checking "%s"...' % slack_user['name'])
-            change_found = False
 
             # If it exists update it
             if ChatUser.objects.filter(user_id=slack_id).exists():
                 self.log_progress('"%s" exists, checking fields...' % slack_user['name'])
                 db_user = ChatUser.objects.get(user_id=slack_id)
 
-                for field in self.UPDATE_FIELDS:
-                    # Get the db value for the field
-                    db_field = getattr(db_user, field)
-
-                    # Get the slack API call value for the field
-                    if field[:6] == 'image_':
-                        user_field = slack_user['profile'][field]
-                    else:
-                        user_field = slack_user.get(field, None)
-
-                    # Compare the fields and update if different
-                    if user_field and db_field != user_field:
-                        self.log_progress('Change Found: Updating "%s" from "%s" to "%s" for user "%s"' % (
-                            field,
-                            db_field,
-                            user_field,
-                            slack_user['name']
-                        ))
-                        change_found = True
-                        setattr(db_user, field, user_field)
-
-                if change_found:
+                if self.update_user(db_user, slack_user):
                     db_user.save()
-                    change_found = False
+                    self.counts['updated'] += 1
+                else:
+                    self.counts['unchanged'] += 1
 
             # If not, add it
             else:
                 self.log_progress('No user found. Adding "%s".' % slack_user['name'])
-                user_data = {
-                    'user_id': slack_id,
-                    'name': slack_user.get('name', ''),
-                    'real_name': slack_user.get('real_name', ''),
-                    'image_24': slack_user['profile'].get('image_24', ''),
-                    'image_32': slack_user['profile'].get('image_32', ''),
-                    'image_48': slack_user['profile'].get('image_48', ''),
-                    'image_72': slack_user['profile'].get('image_72', ''),
-                    'image_192': slack_user['profile'].get('image_192', ''),
-                }
-                u = ChatUser(**user_data)
+                u = self.build_user(slack_user)
                 u.save()
+                self.counts['added'] += 1
+
+    def sync_bulk(self, users, batch_size):
+        """
+        Compares a page of users against the database in memory and saves
+        the changes with a few bulk queries.
+        """
+        slack_ids = [slack_user['id'] for slack_user in users]
+        db_users = dict(
+            (u.user_id, u) for u in ChatUser.objects.filter(user_id__in=slack_ids)
+        )
+
+        new_users = []
+        changed_users = []
+        changed_fields = set()
+        # Users whose messages need their feed representation refreshed
+        feed_users = []
+        for slack_user in users:
+            slack_id = slack_user['id']
+            db_user = db_users.get(slack_id)
+
+            if db_user is None:
+                self.log_progress('No user found. Adding "%s".' % slack_user['name'])
+                db_user = self.build_user(slack_user)
+                db_users[slack_id] = db_user
+                new_users.append(db_user)
+            elif db_user.pk is not None:
+                fields = self.update_user(db_user, slack_user)
+                if fields:
+                    changed_users.append(db_user)
+                    changed_fields.update(fields)
+                    if set(fields) & set(ChatUser.FEED_FIELDS):
+                        feed_users.append(db_user)
+
+        for batch in chunks(new_users, batch_size):
+            ChatUser.objects.bulk_create(batch)
+        bulk_update(changed_users, sorted(changed_fields), batch_size)
+        if feed_users:
+            tasks.publish_users(feed_users)
+
+        self.counts['added'] += len(new_users)
+        self.counts['updated'] += len(changed_users)
+        self.counts['unchanged'] += len(users) - len(new_users) - len(changed_users)
@@ -8,6 +8,12 @@ class ChatMessageQuerySet(models.QuerySet):
     def live(self):
         return self.filter(live=True).order_by('-ts')
 
+    def feed(self):
+        """
+        Live messages with only the fields used by the JSON feed.
+        """
+        return self.live().only('ts', 'feed_json')
+
 
 class ChatMessageManager(models.Manager):
     """
@@ -18,3 +24,6 @@ class ChatMessageManager(models.Manager):
 
     def live(self):
         return self.get_queryset().live()
+
+    def feed(self):
+        return self.get_queryset().feed()
@@ -0,0 +1,312 @@
+"""
+Timings and counters of the ingest and publish paths, exposed in the
+Prometheus text format at /metrics.
+
+Timed sections record their duration and, with CHAT_METRICS_COUNT_QUERIES,
+the number of database queries they ran. Sections slower than their
+threshold in CHAT_METRICS_SLOW_THRESHOLDS are logged to the `chat.slow`
+logger.
+
+Metrics are kept per process. With chat.workers.ProcessBackend the tasks
+run in the worker processes and aren't included in the web process' metrics.
+"""
+import bisect
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+slow_logger = logging.getLogger('chat.slow')
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+
+_local = threading.local()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """
+    A value that only goes up, per set of labels.
+    """
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield self.name, labels, value
+
+
+class Histogram(object):
+    """
+    Counts the observed values in cumulative buckets, per set of labels.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        self.add(tuple(sorted(labels.items())), value)
+
+    def add(self, key, value):
+        """
+        Observes a value for labels already sorted into a tuple.
+        """
+        with self.lock:
+            if key not in self.values:
+                # Count per bucket, then the sum and count of all values
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            counts = self.values[key]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(c[0]), c[1], c[2])) for key, c in self.values.items())
+        for labels, (bucket_counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', labels + (('le', format_value(bound)),), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class Gauge(object):
+    """
+    Values read when the metrics are collected, from a function returning
+    a list of (labels dict, value) pairs. Counters kept elsewhere, like the
+    cache hits, are exposed the same way with the `counter` type.
+    """
+    def __init__(self, name, help, collect, type='gauge'):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.type = type
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield self.name, tuple(sorted(labels.items())), value
+
+
+class Registry(object):
+    """
+    The metrics of this process.
+    """
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self.metrics.get(name) or self.register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=SECONDS_BUCKETS):
+        return self.metrics.get(name) or self.register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, collect, type='gauge'):
+        return self.metrics.get(name) or self.register(Gauge(name, help, collect, type))
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def start_counting_queries():
+    """
+    Returns the connection and the position in its query log a timed
+    section starts at, or None if queries aren't counted.
+    """
+    if not settings.CHAT_METRICS_COUNT_QUERIES:
+        return None
+    connection = connections[DEFAULT_DB_ALIAS]
+    depth = getattr(_local, 'depth', 0)
+    if depth == 0:
+        _local.force_debug_cursor = connection.force_debug_cursor
+        # A full log doesn't grow anymore, start over like each request does,
+        # unless something else like CaptureQueriesContext is reading it
+        if not connection.queries_logged and len(connection.queries_log) >= connection.queries_limit:
+            connection.queries_log.clear()
+        connection.force_debug_cursor = True
+    _local.depth = depth + 1
+    return connection, len(connection.queries_log)
+
+
+def stop_counting_queries(start):
+    if start is None:
+        return None
+    connection, position = start
+    # Queries can't be counted in a log that was already full
+    count = len(connection.queries_log) - position if position < connection.queries_limit else None
+    _local.depth -= 1
+    if _local.depth == 0:
+        connection.force_debug_cursor = _local.force_debug_cursor
+    return count
+
+
+class Section(object):
+    """
+    A timed section of code, recording its duration in the
+    `<name>_seconds` histogram and its number of queries in
+    `<name>_queries`.
+    """
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = tuple(sorted(labels.items()))
+        self.seconds = registry.histogram(name + '_seconds', 'Duration of %s in seconds.' % name)
+        self.queries = registry.histogram(
+            name + '_queries',
+            'Database queries run by %s.' % name,
+            QUERIES_BUCKETS
+        )
+
+    def start(self):
+        return time.time(), start_counting_queries()
+
+    def stop(self, started):
+        start, queries_start = started
+        elapsed = time.time() - start
+        queries = stop_counting_queries(queries_start)
+
+        self.seconds.add(self.labels, elapsed)
+        if queries is not None:
+            self.queries.add(self.labels, queries)
+
+        threshold = settings.CHAT_METRICS_SLOW_THRESHOLDS.get(self.name)
+        if threshold is not None and elapsed >= threshold:
+            slow_logger.warning(
+                '%s%s took %.3fs and %s queries.',
+                self.name,
+                format_labels(self.labels),
+                elapsed,
+                '?' if queries is None else queries
+            )
+
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Times the code run inside the block.
+    """
+    section = Section(name, **labels)
+    started = section.start()
+    try:
+        yield
+    finally:
+        section.stop(started)
+
+
+def timed_function(name, **labels):
+    """
+    Decorates a function to time each of its calls.
+    """
+    def decorator(func):
+        section = Section(name, **labels)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = section.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                section.stop(started)
+        return wrapper
+    return decorator
+
+
+def inc(name, help, amount=1, **labels):
+    registry.counter(name, help).inc(amount, **labels)
+
+
+def observe(name, help, value, buckets=SECONDS_BUCKETS, **labels):
+    registry.histogram(name, help, buckets).observe(value, **labels)
+
+
+def collect_dedup():
+    from chat.dedup import get_store
+    return [({'count': key}, value) for key, value in sorted(get_store().stats().items())]
+
+
+def collect_user_cache():
+    from chat.directory import directory
+    stats = directory.stats()
+    return [({'result': 'hit'}, stats['hits']), ({'result': 'miss'}, stats['misses'])]
+
+
+def collect_caches():
+    from chat.directory import directory
+    from chat.render import parse_cache
+    return [
+        ({'cache': 'users'}, len(directory.users)),
+        ({'cache': 'render'}, len(parse_cache.items)),
+    ]
+
+
+def collect_pending_publishes():
+    from chat.scheduler import scheduler
+    return [({}, len(scheduler.pending))]
+
+
+def collect_stream_clients():
+    from chat import broker
+    if broker._broker is None:
+        return [({}, 0)]
+    return [({}, broker._broker.clients)]
+
+
+registry.gauge('chat_dedup_events', 'Slack events checked for redeliveries.', collect_dedup, 'counter')
+registry.gauge('chat_user_cache_lookups', 'Lookups of the user cache.', collect_user_cache, 'counter')
+registry.gauge('chat_cache_size', 'Number of entries of the in-process caches.', collect_caches)
+registry.gauge('chat_publish_pending', 'Channels waiting to be published.', collect_pending_publishes)
+registry.gauge('chat_stream_clients', 'Clients connected to the live streams.', collect_stream_clients)
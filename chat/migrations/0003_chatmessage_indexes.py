@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-18 11:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_messages(apps, schema_editor):
+    """
+    Keeps only the first message saved for each channel and ts.
+    """
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    duplicates = ChatMessage.objects.values('channel', 'ts').annotate(
+        count=Count('id'),
+        first_id=Min('id'),
+    ).filter(count__gt=1)
+    for duplicate in duplicates:
+        ChatMessage.objects.filter(
+            channel=duplicate['channel'],
+            ts=duplicate['ts'],
+        ).exclude(id=duplicate['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_chatmessage_html_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_messages, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='chatmessage',
+            unique_together=set([('channel', 'ts')]),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=[b'channel', b'live', b'ts'], name=b'chat_message_feed_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-18 12:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chatmessage_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatchannel',
+            name='last_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, help_text=b"When the channel's feed last changed."),
+        ),
+        migrations.AddField(
+            model_name='chatchannel',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text=b"Incremented every time the channel's feed changes."),
+        ),
+    ]
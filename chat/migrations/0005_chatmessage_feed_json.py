@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-18 12:16
+from __future__ import unicode_literals
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import migrations, models, transaction
+
+
+def encode_feed_json(apps, schema_editor):
+    """
+    Fills the feed representation of the existing messages.
+    """
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    encoder = DjangoJSONEncoder()
+    messages = ChatMessage.objects.select_related('user').only(
+        'html', 'ts', 'user__name', 'user__real_name', 'user__image_48'
+    ).order_by('pk')
+
+    last_pk = 0
+    while True:
+        batch = list(messages.filter(pk__gt=last_pk)[:1000])
+        if not batch:
+            return
+        with transaction.atomic():
+            for message in batch:
+                message.feed_json = encoder.encode({
+                    'html': message.html,
+                    'ts': message.ts,
+                    'user': {
+                        'image_48': message.user.image_48,
+                        'display_name': message.user.real_name or message.user.name
+                    }
+                })
+                message.save(update_fields=['feed_json'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatchannel_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='feed_json',
+            field=models.TextField(blank=True, editable=False, help_text=b"The message's JSON feed representation, pre-encoded."),
+        ),
+        migrations.RunPython(encode_feed_json, migrations.RunPython.noop),
+    ]
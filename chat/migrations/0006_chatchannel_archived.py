@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-18 12:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chatmessage_feed_json'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatchannel',
+            name='archived',
+            field=models.BooleanField(default=False, editable=False, help_text=b'Archived channels are frozen: new Slack events are ignored and the API serves their final snapshot.'),
+        ),
+        migrations.AddField(
+            model_name='chatchannel',
+            name='snapshot',
+            field=models.CharField(blank=True, editable=False, help_text=b"Name of the archived channel's final feed file, with a hash of its content.", max_length=300),
+        ),
+    ]
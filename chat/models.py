@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import re
-import slackdown
 import json
-from chat import managers
+from chat import managers, metrics, render, serializers
+from chat.directory import channels, directory
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
 
 
 class ChatChannel(models.Model):
@@ -43,9 +44,53 @@ class ChatChannel(models.Model):
         blank=True,
     )
 
+    #
+    # Feed fields
+    #
+    version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text="Incremented every time the channel's feed changes."
+    )
+    last_modified = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        help_text="When the channel's feed last changed."
+    )
+
+    #
+    # Archive fields
+    #
+    archived = models.BooleanField(
+        default=False,
+        editable=False,
+        help_text="Archived channels are frozen: new Slack events are ignored "
+                  "and the API serves their final snapshot."
+    )
+    snapshot = models.CharField(
+        max_length=300,
+        blank=True,
+        editable=False,
+        help_text="Name of the archived channel's final feed file, with a hash of its content."
+    )
+
     def __str__(self):
         return self.slug
 
+    def touch(self):
+        """
+        Marks the channel's feed as changed, without overwriting
+        the other fields. Returns the new version, which is ahead
+        by more than one if other processes changed the channel.
+        """
+        self.last_modified = timezone.now()
+        ChatChannel.objects.filter(pk=self.pk).update(
+            version=F('version') + 1,
+            last_modified=self.last_modified
+        )
+        self.version = ChatChannel.objects.filter(pk=self.pk).values_list('version', flat=True).get()
+        return self.version
+
     def save(self, *args, **kwargs):
         import tasks
         if not self.pk:
@@ -57,8 +102,32 @@ class ChatChannel(models.Model):
             tasks.post_slack_message(self.channel_id, text=msg)
 
         super(ChatChannel, self).save(*args, **kwargs)
+        channels.invalidate()
+        # The feed of an archived channel is frozen
+        if self.archived:
+            return
+        self.touch()
+
+        tasks.publish_channel(self)
+
+    def archive(self):
+        """
+        Freezes the channel and publishes its final snapshot.
+        """
+        import tasks
+        tasks.archive_channel(self)
+
+    def unarchive(self):
+        """
+        Records the channel's events and publishes its changes again.
+        """
+        import tasks
+        tasks.unarchive_channel(self)
 
-        tasks.publish_json(self.channel_id)
+    def delete(self, *args, **kwargs):
+        result = super(ChatChannel, self).delete(*args, **kwargs)
+        channels.invalidate()
+        return result
 
 
 class ChatUser(models.Model):
@@ -85,6 +154,9 @@ class ChatUser(models.Model):
     image_72 = models.URLField(max_length=1000)
     image_192 = models.URLField(max_length=1000)
 
+    # The fields copied into the feed fragments of the user's messages
+    FEED_FIELDS = ('name', 'real_name', 'image_48')
+
     class Meta:
         ordering = ('name',)
 
@@ -98,6 +170,25 @@ class ChatUser(models.Model):
         """
         return self.real_name or self.name
 
+    def get_feed_values(self):
+        return tuple(getattr(self, field) for field in self.FEED_FIELDS)
+
+    def save(self, *args, **kwargs):
+        old_values = None
+        if self.pk:
+            old_values = ChatUser.objects.filter(pk=self.pk).values_list(*self.FEED_FIELDS).first()
+
+        super(ChatUser, self).save(*args, **kwargs)
+        directory.invalidate(self.user_id)
+
+        if old_values and old_values != self.get_feed_values():
+            import tasks
+            tasks.publish_users([self])
+
+    def delete(self, *args, **kwargs):
+        directory.invalidate(self.user_id)
+        return super(ChatUser, self).delete(*args, **kwargs)
+
 
 class ChatMessage(models.Model):
     """
@@ -144,47 +235,74 @@ class ChatMessage(models.Model):
         help_text="Override the message by putting text here."
     )
 
+    html_hash = models.CharField(
+        max_length=40,
+        blank=True,
+        editable=False,
+        help_text='Hash of the source and mentioned names the html was rendered from.'
+    )
+
+    feed_json = models.TextField(
+        blank=True,
+        editable=False,
+        help_text="The message's JSON feed representation, pre-encoded."
+    )
+
     objects = models.Manager()
     messages = managers.ChatMessageManager()
 
     class Meta:
         ordering = ("-ts",)
         get_latest_by = "ts"
+        unique_together = (("channel", "ts"),)
+        indexes = [
+            models.Index(fields=["channel", "live", "ts"], name="chat_message_feed_idx"),
+        ]
 
     def __str__(self):
         return self.ts
 
+    @metrics.timed_function('chat_render')
     def update_html(self):
         """
         Updates the html field with the Slack data or
         with the override_text if it's not blank.
+
+        Returns False without rendering if neither the source nor the
+        names of the users it mentions changed since the last render.
+        """
+        source = render.get_source(self.data, self.override_text)
+        names = render.get_mentioned_names(source)
+        key = render.get_render_key(source, names)
+        if key == self.html_hash:
+            metrics.inc('chat_render_total', 'Messages rendered or skipped.', result='skipped')
+            return False
+
+        self.html = render.render(source, names)
+        self.html_hash = key
+        metrics.inc('chat_render_total', 'Messages rendered or skipped.', result='rendered')
+        return True
+
+    def update_feed_json(self):
+        """
+        Encodes the message's feed representation again, after
+        its html or its user changed.
         """
-        if self.override_text != '':
-            override_text_obj = {
-                'text': self.override_text
-            }
-            self.html = slackdown.parse(override_text_obj)
-        else:
-            self.html = slackdown.parse(json.loads(self.data))
-
-        # convert user references with full names (or usernames as a fallback)
-        users = re.finditer(r'@([\w\d]*)', self.html)
-        for u in users:
-            match = u.group(1)
-            if ChatUser.objects.filter(user_id=match).exists():
-                user_obj = ChatUser.objects.get(user_id=match)
-                name = "@{}".format(user_obj.display_name).replace(" ", "")
-                self.html = u"{}<span class='chat-mention'>{}</span>{}".format(
-                    self.html[:u.start()],
-                    name,
-                    self.html[u.end():]
-                )
+        self.feed_json = serializers.encode_message(self)
 
     def save(self, *args, **kwargs):
-        self.ts = self.data['ts']
+        self.ts = json.loads(self.data)['ts']
         self.update_html()
+        # The author's names are stored in feed_json, so they're read from
+        # the database rather than from the directory, which can be stale
+        self.user = ChatUser.objects.only(*ChatUser.FEED_FIELDS).get(pk=self.user_id)
+        self.update_feed_json()
+        created = not self.pk
 
         super(ChatMessage, self).save(*args, **kwargs)
+        if self.channel.archived:
+            return
+        self.channel.touch()
 
         import tasks
-        tasks.publish_json(self.channel.channel_id)
+        tasks.publish_message(self, created)
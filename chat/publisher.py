@@ -0,0 +1,279 @@
+"""
+Incremental publishing of the channel JSONP feeds.
+
+Each channel keeps its rendered feed in memory so that a single message being
+added, edited or deleted only touches that message instead of re-rendering
+the whole channel. Every change is also recorded in a short log that is
+published next to the full snapshot so readers can poll for recent changes.
+
+Other processes change the channels too, so each cached feed remembers the
+ChatChannel.version it was rendered at. A feed that missed changes is
+reloaded from the database before it's changed or written.
+"""
+import bisect
+import collections
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from chat import metrics
+from chat.broker import get_broker
+from chat.compression import ENCODINGS
+from chat.serializers import dumps_jsonp, iter_channel_feed, serialize_channel, serialize_message
+from chat.storage import get_storage
+
+_feeds = OrderedDict()
+_feeds_lock = threading.Lock()
+
+
+class ChannelFeed(object):
+    """
+    The rendered state of a channel's feed.
+    """
+    def __init__(self, channel, messages):
+        """
+        `messages` is an iterable of (ts, feed_json) pairs and
+        `channel.version` the version they were read at.
+        """
+        self.channel_id = channel.channel_id
+        self.version = channel.version
+        self.channel = serialize_channel(channel)
+        self.messages = dict(messages)
+        self.order = sorted(self.messages)
+        self.changes = collections.deque(maxlen=settings.CHAT_DELTA_SIZE)
+        self.lock = threading.RLock()
+
+    def record(self, action, data):
+        """
+        Adds a change to the delta log and sends it to the live stream.
+        """
+        change = {
+            'ts': '%.6f' % time.time(),
+            'action': action,
+            'data': data,
+        }
+        self.changes.append(change)
+        get_broker().publish(self.channel_id, change)
+
+    def update_channel(self, channel):
+        """
+        Replaces the channel metadata. Returns whether it changed.
+        """
+        output_channel = serialize_channel(channel)
+        if output_channel == self.channel:
+            return False
+        self.channel = output_channel
+        self.record('channel', output_channel)
+        return True
+
+    def update_message(self, message):
+        """
+        Adds, replaces or removes a message depending on whether it's live.
+        Returns the action recorded, or None if nothing changed.
+        """
+        ts = message.ts
+        if not message.live:
+            if ts not in self.messages:
+                return None
+            del self.messages[ts]
+            self.order.pop(bisect.bisect_left(self.order, ts))
+            action = 'deleted'
+            self.record(action, {'ts': ts})
+            return action
+
+        if ts in self.messages:
+            if self.messages[ts] == message.feed_json:
+                return None
+            action = 'changed'
+        else:
+            bisect.insort(self.order, ts)
+            action = 'added'
+        self.messages[ts] = message.feed_json
+        self.record(action, serialize_message(message))
+        return action
+
+    def refresh(self, channel, messages):
+        """
+        Replaces the feed with a newer state read from the database,
+        recording what changed since.
+        """
+        self.update_channel(channel)
+        messages = dict(messages)
+        for ts in self.order:
+            if ts not in messages:
+                self.record('deleted', {'ts': ts})
+        for ts in sorted(messages):
+            old = self.messages.get(ts)
+            if old != messages[ts]:
+                self.record('added' if old is None else 'changed', json.loads(messages[ts]))
+        self.messages = messages
+        self.order = sorted(messages)
+        self.version = channel.version
+
+    def iter_messages(self):
+        """
+        Yields the encoded messages, newest first.
+        """
+        for ts in reversed(self.order):
+            yield self.messages[ts]
+
+    def delta_as_dict(self):
+        """
+        Returns the recent changes, oldest first. Readers that last polled
+        before `since` have missed changes and should reload the snapshot.
+        """
+        changes = list(self.changes)
+        return {
+            'channel': self.channel_id,
+            'since': changes[0]['ts'] if changes else None,
+            'latest': changes[-1]['ts'] if changes else None,
+            'changes': changes,
+        }
+
+
+def cache_feed(feed):
+    with _feeds_lock:
+        _feeds.pop(feed.channel_id, None)
+        _feeds[feed.channel_id] = feed
+        while len(_feeds) > settings.CHAT_FEED_CACHE_SIZE:
+            _feeds.popitem(last=False)
+
+
+def get_cached_feed(channel_id):
+    with _feeds_lock:
+        feed = _feeds.pop(channel_id, None)
+        if feed is not None:
+            _feeds[channel_id] = feed
+    return feed
+
+
+def load_feed(channel, changes=()):
+    """
+    Renders a channel's feed from the database and caches it. A feed
+    already cached is refreshed instead, recording what changed.
+
+    A rendered feed has nothing to compare with, so `changes`, the
+    (action, data) pairs of the change that triggered the render, are
+    recorded instead.
+    """
+    from chat.models import ChatChannel, ChatMessage
+    # Read the version first, the messages are at least as recent
+    channel = ChatChannel.objects.get(channel_id=channel.channel_id)
+    messages = list(ChatMessage.messages.live().filter(channel=channel).values_list('ts', 'feed_json'))
+
+    feed = get_cached_feed(channel.channel_id)
+    if feed is None:
+        feed = ChannelFeed(channel, messages)
+        for action, data in changes:
+            feed.record(action, data)
+        cache_feed(feed)
+    else:
+        with feed.lock:
+            feed.refresh(channel, messages)
+    return feed
+
+
+def get_version(channel_id):
+    from chat.models import ChatChannel
+    return ChatChannel.objects.filter(channel_id=channel_id).values_list('version', flat=True).first()
+
+
+def update_feed(channel, update, changes):
+    """
+    Applies a change made by this process to the cached feed of a channel
+    with `update(feed)`, which returns whether the feed changed.
+    `channel.version` is the version touch() bumped the channel to for this
+    change, the feed is reloaded instead if it missed other changes.
+    `changes` are the (action, data) pairs recorded for the change if the
+    feed wasn't cached and has to be rendered.
+    """
+    feed = get_cached_feed(channel.channel_id)
+    if feed is not None:
+        with feed.lock:
+            if feed.version == channel.version - 1:
+                changed = update(feed)
+                feed.version = channel.version
+                return changed
+    load_feed(channel, changes)
+    return True
+
+
+def forget_feed(channel_id=None):
+    """
+    Drops the cached feed for a channel, or for all channels.
+    """
+    with _feeds_lock:
+        if channel_id is None:
+            _feeds.clear()
+        else:
+            _feeds.pop(channel_id, None)
+
+
+def to_jsonp(data):
+    return "%s(%s);" % ("callback", json.dumps(data, cls=DjangoJSONEncoder))
+
+
+@metrics.timed_function('chat_feed_write')
+def write_feed(feed):
+    """
+    Writes the full snapshot and the delta file of a feed.
+    """
+    storage = get_storage()
+
+    # Rendering inside the storage lock makes sure the last render of
+    # a channel is also the last one written. Checking the version there
+    # too keeps a feed that missed changes from overwriting them.
+    with storage.lock(feed.channel_id):
+        if feed.version != get_version(feed.channel_id):
+            feed = load_feed(feed)
+        with feed.lock:
+            jsonp_string = dumps_jsonp(feed.channel, feed.iter_messages())
+            delta_string = to_jsonp(feed.delta_as_dict())
+
+        save_file(storage, '%s.jsonp' % feed.channel_id, jsonp_string)
+        save_file(storage, '%s.delta.jsonp' % feed.channel_id, delta_string)
+
+
+def save_file(storage, name, content):
+    """
+    Saves a file and its precompressed variants, if it changed.
+    """
+    if not storage.save(name, content):
+        metrics.inc('chat_feed_files_unchanged_total', 'Feed files not written as they were unchanged.')
+        return
+
+    metrics.inc('chat_feed_bytes_written_total', 'Bytes of feed files written.', len(content), encoding='identity')
+    for encoding, extension, compress in ENCODINGS:
+        compressed = compress(content)
+        if storage.save('%s.%s' % (name, extension), compressed, encoding):
+            metrics.inc('chat_feed_bytes_written_total', 'Bytes of feed files written.', len(compressed), encoding=encoding)
+
+
+def write_snapshot(channel):
+    """
+    Writes the final JSON feed of an archived channel, named after a hash
+    of its content so it can be cached forever, and returns its name.
+    """
+    from chat.models import ChatMessage
+    messages = ChatMessage.messages.feed().filter(channel=channel)
+    content = ''.join(iter_channel_feed(channel, messages, next_cursor=None))
+    name = '%s.%s.json' % (channel.channel_id, hashlib.sha1(content).hexdigest()[:16])
+
+    storage = get_storage()
+    with storage.lock(channel.channel_id):
+        save_file(storage, name, content)
+    return name
+
+
+def write_channel(channel_id):
+    """
+    Writes the cached feed of a channel, rendering it if needed.
+    """
+    feed = get_cached_feed(channel_id)
+    if feed is None:
+        from chat.models import ChatChannel
+        feed = load_feed(ChatChannel.objects.get(channel_id=channel_id))
+    write_feed(feed)
@@ -0,0 +1,109 @@
+"""
+Rendering of the Slack message data to HTML.
+
+Rendering is keyed by a hash of the message source and the names of the
+users it mentions, so a message is only rendered again when one of those
+changes. The slackdown output is also cached by source so messages that
+share a source don't parse it twice.
+"""
+import hashlib
+import json
+import re
+import slackdown
+from django.conf import settings
+from chat.directory import directory
+from chat.utils import LRUCache
+
+MENTION_REGEX = re.compile(r'@([\w\d]*)')
+
+# Slack's mention syntax in the message source, like <@U024BE7LH> or
+# <@U024BE7LH|bob>, so emails and other @ don't look like user ids
+SOURCE_MENTION_REGEX = re.compile(r'<@([UW][A-Z0-9]+)(?:\|[^>]*)?>')
+
+parse_cache = LRUCache(settings.CHAT_RENDER_CACHE_SIZE)
+
+
+def get_source(data, override_text=''):
+    """
+    Returns the JSON source a message is rendered from, which is
+    the override text if it's not blank.
+    """
+    if override_text != '':
+        return json.dumps({'text': override_text})
+    return data
+
+
+def get_mentioned_ids(source):
+    return set(SOURCE_MENTION_REGEX.findall(source))
+
+
+def get_mentioned_names(source):
+    """
+    Returns a dict of the display names of the users mentioned in a source.
+    """
+    user_ids = get_mentioned_ids(source)
+    if not user_ids:
+        return {}
+    users = directory.get_many(list(user_ids))
+    return dict((user_id, u.display_name) for user_id, u in users.items())
+
+
+def get_render_key(source, names):
+    """
+    Returns a hash identifying the HTML rendered from a source.
+    """
+    key = hashlib.sha1(source.encode('utf-8'))
+    for user_id in sorted(names):
+        key.update(u'\0{}={}'.format(user_id, names[user_id]).encode('utf-8'))
+    return key.hexdigest()
+
+
+def parse(source):
+    """
+    Returns the slackdown HTML of a source.
+    """
+    digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    html = parse_cache.get(digest)
+    if html is None:
+        html = slackdown.parse(json.loads(source))
+        parse_cache.set(digest, html)
+    return html
+
+
+def replace_mentions(html, names):
+    """
+    Replaces every `@user_id` in the html with the user's display name.
+    """
+    def replace(match):
+        name = names.get(match.group(1))
+        if name is None:
+            return match.group(0)
+        return u"<span class='chat-mention'>@{}</span>".format(name.replace(" ", ""))
+
+    return MENTION_REGEX.sub(replace, html)
+
+
+def render(source, names):
+    """
+    Returns the HTML of a source, with user references converted to their
+    full names (or usernames as a fallback).
+    """
+    return replace_mentions(parse(source), names)
+
+
+def render_many(sources):
+    """
+    Returns the HTML and render key of many sources, looking up the users
+    mentioned in all of them at once.
+    """
+    mentioned_ids = [get_mentioned_ids(source) for source in sources]
+    all_ids = set().union(*mentioned_ids) if mentioned_ids else set()
+    users = directory.get_many(list(all_ids)) if all_ids else {}
+
+    rendered = []
+    for source, user_ids in zip(sources, mentioned_ids):
+        names = dict(
+            (user_id, users[user_id].display_name) for user_id in user_ids if user_id in users
+        )
+        rendered.append((render(source, names), get_render_key(source, names)))
+    return rendered
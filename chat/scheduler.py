@@ -0,0 +1,112 @@
+"""
+Debounced publishing of the channel feeds.
+
+A burst of messages in a channel schedules a single publish once the channel
+has been quiet for `window` seconds, but never later than `max_latency`
+seconds after the first change of the burst.
+"""
+import logging
+import threading
+import time
+from multiprocessing import util
+from django import db
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PublishScheduler(object):
+    """
+    Coalesces publish requests per channel. A single thread publishes
+    the channels as their deadlines pass.
+    """
+    def __init__(self, publish, window, max_latency):
+        self.publish = publish
+        self.window = window
+        self.max_latency = max_latency
+        # The time of the first request and the deadline of each channel
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, channel_id):
+        """
+        Requests a publish of a channel.
+        """
+        if self.window <= 0:
+            self.publish(channel_id, time.time())
+            return
+
+        now = time.time()
+        with self.condition:
+            first_requested = self.pending[channel_id][0] if channel_id in self.pending else now
+            deadline = min(now + self.window, first_requested + self.max_latency)
+            self.pending[channel_id] = (first_requested, deadline)
+            # Forked processes don't inherit the thread
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='chat-scheduler')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def get_due(self):
+        """
+        Waits until some channels are due and removes them from the
+        pending ones. Returns their (channel_id, first_requested) pairs.
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+                due = [
+                    (channel_id, first_requested)
+                    for channel_id, (first_requested, deadline) in self.pending.items()
+                    if deadline <= now
+                ]
+                if due:
+                    for channel_id, first_requested in due:
+                        del self.pending[channel_id]
+                    return due
+                if self.pending:
+                    self.condition.wait(min(deadline for first_requested, deadline in self.pending.values()) - now)
+                else:
+                    self.condition.wait()
+
+    def run(self):
+        while True:
+            for channel_id, first_requested in self.get_due():
+                try:
+                    self.publish(channel_id, first_requested)
+                except Exception:
+                    logger.exception('Could not publish %s.', channel_id)
+            db.connections.close_all()
+
+    def flush_all(self):
+        """
+        Publishes every pending channel right away.
+        """
+        with self.condition:
+            pending, self.pending = self.pending, {}
+        for channel_id, (first_requested, deadline) in pending.items():
+            self.publish(channel_id, first_requested)
+
+
+def publish(channel_id, first_requested=None):
+    import metrics
+    import publisher
+    publisher.write_channel(channel_id)
+    if first_requested is not None:
+        metrics.observe(
+            'chat_publish_lag_seconds',
+            'Seconds between the first change of a channel and its publish.',
+            time.time() - first_requested
+        )
+
+
+scheduler = PublishScheduler(
+    publish,
+    settings.CHAT_PUBLISH_WINDOW,
+    settings.CHAT_PUBLISH_MAX_LATENCY
+)
+
+# Publish what's pending when the interpreter exits
+util.Finalize(None, scheduler.flush_all, exitpriority=10)
@@ -0,0 +1,89 @@
+"""
+Serialization of the channel feeds, shared by the JSON API and the publisher.
+
+Each message keeps its feed representation pre-encoded in its `feed_json`
+field, refreshed when the message or its author changes, so a feed is
+assembled by joining those fragments rather than encoding every message
+again.
+"""
+from itertools import chain, islice
+from django.core.serializers.json import DjangoJSONEncoder
+
+encoder = DjangoJSONEncoder()
+
+# Number of message fragments joined into each chunk of the feed
+JOIN_BATCH_SIZE = 500
+
+
+def serialize_channel(channel):
+    """
+    Returns the feed representation of a ChatChannel.
+    """
+    return {
+        'id': channel.channel_id,
+        'headline': channel.headline,
+        'slug': channel.slug,
+        'description': channel.description,
+        'live_content': channel.live_content,
+    }
+
+
+def serialize_message(message):
+    """
+    Returns the feed representation of a ChatMessage.
+    """
+    return {
+        'html': message.html,
+        'ts': message.ts,
+        'user': {
+            'image_48': message.user.image_48,
+            'display_name': message.user.display_name
+        }
+    }
+
+
+def encode_message(message):
+    """
+    Returns the JSON encoded feed representation of a ChatMessage.
+    """
+    return encoder.encode(serialize_message(message))
+
+
+def iter_feed(channel, fragments, **extra):
+    """
+    Yields the JSON encoded feed in chunks. `channel` is the serialized
+    channel, `fragments` an iterable of encoded messages and `extra`
+    any other keys of the document.
+    """
+    yield '{"channel": %s, "messages": [' % encoder.encode(channel)
+    fragments = iter(fragments)
+    separator = ''
+    while True:
+        batch = list(islice(fragments, JOIN_BATCH_SIZE))
+        if not batch:
+            break
+        yield separator + ', '.join(batch)
+        separator = ', '
+    yield ']'
+    for key in sorted(extra):
+        yield ', %s: %s' % (encoder.encode(key), encoder.encode(extra[key]))
+    yield '}'
+
+
+def iter_channel_feed(channel, messages, **extra):
+    """
+    Yields the JSON encoded feed of a ChatChannel and its ChatMessages,
+    either a queryset or a list of instances.
+    """
+    if hasattr(messages, 'values_list'):
+        fragments = messages.values_list('feed_json', flat=True).iterator()
+    else:
+        fragments = (message.feed_json for message in messages)
+    return iter_feed(serialize_channel(channel), fragments, **extra)
+
+
+def dumps_jsonp(channel, fragments, callback='callback', **extra):
+    """
+    Returns the feed wrapped in a JSONP callback.
+    """
+    return ''.join(chain(['%s(' % callback], iter_feed(channel, fragments, **extra), [');']))
@@ -113,3 +113,94 @@ STATIC_URL = '/static/'
 SLACK_APP_TOKEN = os.getenv("slack_app_token")
 SLACK_BOT_TOKEN = os.getenv("slack_bot_token")
 SLACK_VERIFICATION_TOKEN = os.getenv("slack_verification_token")
+SLACK_API_URL = 'https://slack.com/api/'
+
+# Background task queue used to process Slack events off the request path.
+# Use chat.workers.ProcessBackend for a pool of processes, or
+# chat.workers.SyncBackend to run tasks inside the request.
+CHAT_TASK_BACKEND = 'chat.workers.ThreadBackend'
+CHAT_TASK_WORKERS = 4
+
+# Publishes of a channel's feed are coalesced until no change happened for
+# CHAT_PUBLISH_WINDOW seconds, waiting at most CHAT_PUBLISH_MAX_LATENCY
+# seconds after the first change. A window of 0 publishes every change.
+CHAT_PUBLISH_WINDOW = 1.0
+CHAT_PUBLISH_MAX_LATENCY = 5.0
+
+# Number of rendered channel feeds kept in memory by each process
+CHAT_FEED_CACHE_SIZE = 100
+
+# Number of recent changes kept in each channel's delta file
+CHAT_DELTA_SIZE = 50
+
+# Maximum number of Slack users kept in the in-process user cache, how
+# often in seconds it's reloaded to pick up changes made by other processes
+# and how long ids without a user are remembered as missing
+CHAT_USER_CACHE_SIZE = 10000
+CHAT_USER_CACHE_TIMEOUT = 300
+CHAT_USER_CACHE_MISS_TIMEOUT = 60
+
+# Number of parsed message sources kept in memory
+CHAT_RENDER_CACHE_SIZE = 1000
+
+# Maximum number of messages returned by a page of the /api/ feed
+CHAT_API_MAX_LIMIT = 500
+
+# Where the JSONP feeds are published. To upload them to a bucket use
+# chat.storage.S3FeedStorage with options like
+# {'bucket': 'my-bucket', 'prefix': 'chat/', 'endpoint_url': None}
+CHAT_FEED_STORAGE = 'chat.storage.LocalFeedStorage'
+CHAT_FEED_STORAGE_OPTIONS = {}
+
+# Live stream of the channel changes at /stream/<channel>. Set the backend
+# to chat.broker.RedisBrokerBackend, with options like
+# {'url': 'redis://localhost:6379/0'}, when changes are applied in other
+# processes than the web server, like with chat.workers.ProcessBackend.
+CHAT_STREAM_BACKEND = None
+CHAT_STREAM_BACKEND_OPTIONS = {}
+# Changes kept per channel for clients resuming with Last-Event-ID
+CHAT_STREAM_HISTORY_SIZE = 200
+# Changes waiting to be sent to a client before it's disconnected
+CHAT_STREAM_CLIENT_QUEUE_SIZE = 100
+# Clients streamed to at the same time by each process. Every client holds
+# a server thread, so keep it well below the number the server runs to
+# leave some for the Slack webhook. Clients over the limit get a 503.
+CHAT_STREAM_MAX_CLIENTS = 20
+# Seconds between keep-alive comments, before a connection is closed
+# and before a client reconnects
+CHAT_STREAM_HEARTBEAT = 15
+CHAT_STREAM_TIMEOUT = 300
+CHAT_STREAM_RETRY = 3
+
+# How often in seconds the cached ids of the logged channels are reloaded
+# to pick up channels added by other processes
+CHAT_CHANNEL_CACHE_TIMEOUT = 60
+
+# Slack event ids are remembered for CHAT_DEDUP_WINDOW seconds so redelivered
+# events are ignored. Use chat.dedup.CacheDedupStore to share them between
+# processes through a Django cache, with options like {'alias': 'default'}.
+CHAT_DEDUP_STORE = 'chat.dedup.MemoryDedupStore'
+CHAT_DEDUP_STORE_OPTIONS = {}
+CHAT_DEDUP_WINDOW = 600
+CHAT_DEDUP_SIZE = 10000
+
+# Maximum number of connections to the Slack API, and of threads
+# posting messages to it
+CHAT_SLACK_POOL_SIZE = 10
+
+# Metrics of the ingest and publish paths, in the Prometheus text format at
+# /metrics. Set the chat_metrics_token environment variable to require an
+# "Authorization: Bearer <token>" header.
+CHAT_METRICS_TOKEN = os.getenv("chat_metrics_token")
+# Also count the queries of each timed section. This turns on Django's debug
+# cursor, which records the SQL of every query and slows down the event
+# handling, so only enable it while profiling.
+CHAT_METRICS_COUNT_QUERIES = False
+# Sections slower than these many seconds are logged to the chat.slow
+# logger, e.g. {'chat_event': 0.5, 'chat_task': 2.0, 'chat_feed_write': 1.0}
+CHAT_METRICS_SLOW_THRESHOLDS = {}
+
+# Seconds the snapshots of archived channels can be cached, and the redirects
+# of the API to them, which change when a channel is unarchived
+CHAT_ARCHIVE_MAX_AGE = 60 * 60 * 24 * 365
+CHAT_ARCHIVE_REDIRECT_MAX_AGE = 60
@@ -0,0 +1,176 @@
+"""
+A shared client for the Slack Web API.
+
+The client reuses its HTTP connections, paces the calls of each method to
+Slack's rate limit tier and waits out the 429 responses it gets anyway.
+Messages can also be posted from a pool of threads, so a burst of them
+doesn't block the caller.
+"""
+import json
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+
+# Calls per minute allowed by Slack for each tier
+# https://api.slack.com/docs/rate-limits
+TIERS = {
+    1: 1,
+    2: 20,
+    3: 50,
+    4: 100,
+    # chat.postMessage allows about one message per second
+    'post': 60,
+}
+
+METHOD_TIERS = {
+    'chat.postMessage': 'post',
+    'conversations.history': 3,
+    'users.list': 2,
+}
+
+DEFAULT_TIER = 3
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` calls per second on average, with bursts of `capacity`.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting for one if the bucket is empty.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token now and wait for it outside the lock
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class SlackWebClient(object):
+    """
+    A Slack Web API client with the same `api_call` interface as
+    slackclient's SlackClient.
+    """
+    def __init__(self, token, api_url='https://slack.com/api/', pool_size=10,
+                 max_retries=3, timeout=10):
+        self.token = token
+        self.api_url = api_url
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+        self.pool = None
+
+    def get_bucket(self, method):
+        tier = METHOD_TIERS.get(method, DEFAULT_TIER)
+        with self.buckets_lock:
+            if tier not in self.buckets:
+                per_minute = TIERS[tier]
+                self.buckets[tier] = TokenBucket(per_minute / 60.0, max(1, per_minute // 10))
+            return self.buckets[tier]
+
+    def api_call(self, method, **kwargs):
+        """
+        Calls a Web API method and returns the decoded response.
+        """
+        data = {'token': self.token}
+        for key, value in kwargs.items():
+            if value is None:
+                continue
+            if isinstance(value, (list, dict)):
+                value = json.dumps(value)
+            data[key] = value
+
+        bucket = self.get_bucket(method)
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            response = self.session.post(self.api_url + method, data=data, timeout=self.timeout)
+            if response.status_code != 429 or attempt == self.max_retries:
+                break
+            retry_after = int(response.headers.get('Retry-After', 1))
+            logger.warning('Slack rate limited %s, retrying in %ss.', method, retry_after)
+            time.sleep(retry_after)
+
+        if response.status_code == 429:
+            return {'ok': False, 'error': 'ratelimited'}
+        return response.json()
+
+    def post_message(self, channel, text=None, attachments=None):
+        return self.api_call(
+            'chat.postMessage',
+            channel=channel,
+            text=text,
+            attachments=attachments
+        )
+
+    def post_message_logged(self, channel, text=None, attachments=None):
+        """
+        Posts a message, logging why it failed if it did. Callers of
+        post_message_async rarely wait for its result.
+        """
+        try:
+            response = self.post_message(channel, text=text, attachments=attachments)
+        except Exception:
+            logger.exception('Could not post a message to %s.', channel)
+            raise
+        if not response.get('ok'):
+            logger.error('Slack refused a message to %s: %s', channel, response.get('error'))
+        return response
+
+    def post_message_async(self, channel, text=None, attachments=None):
+        """
+        Queues a message to be posted from the thread pool and returns
+        its AsyncResult. Failures are logged.
+        """
+        with self.buckets_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.pool_size)
+        # Python 2's apply_async has no error callback
+        return self.pool.apply_async(
+            self.post_message_logged,
+            (channel,),
+            {'text': text, 'attachments': attachments}
+        )
+
+
+def get_client():
+    """
+    Returns the client shared by this process.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = SlackWebClient(
+                    settings.SLACK_BOT_TOKEN,
+                    api_url=settings.SLACK_API_URL,
+                    pool_size=settings.CHAT_SLACK_POOL_SIZE
+                )
+    return _client
@@ -0,0 +1,188 @@
+"""
+Storage backends for the published feed files.
+
+Files are replaced atomically, so readers see either the previous or the new
+version of a file and never a partial one. Content that didn't change since
+the last save isn't written again.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+class FeedStorage(object):
+    """
+    Interface for the feed storage backends.
+    """
+    def __init__(self):
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.digests = {}
+
+    def get_lock(self, key):
+        with self.locks_lock:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+            return self.locks[key]
+
+    @contextmanager
+    def lock(self, key):
+        """
+        Holds a lock on a key, usually a channel id, while its files are saved.
+        """
+        with self.get_lock(key):
+            yield
+
+    def save(self, name, content, encoding=None):
+        """
+        Saves a file unless its content is unchanged. Returns True
+        if the file was written.
+        """
+        digest = hashlib.md5(content).hexdigest()
+        if self.digests.get(name) == (digest, self.get_signature(name)):
+            return False
+        self.write(name, content, encoding)
+        self.digests[name] = (digest, self.get_signature(name))
+        return True
+
+    def get_signature(self, name):
+        """
+        Returns a cheap fingerprint of the stored file, used to notice
+        when another process replaced it.
+        """
+        return None
+
+    def write(self, name, content, encoding):
+        raise NotImplementedError
+
+
+class LocalFeedStorage(FeedStorage):
+    """
+    Saves the files to a local directory.
+    """
+    def __init__(self, location=None):
+        super(LocalFeedStorage, self).__init__()
+        self.location = location or os.path.join(settings.ROOT_DIR, 'chat', '.json')
+
+    def ensure_location(self):
+        if not os.path.isdir(self.location):
+            try:
+                os.makedirs(self.location)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(self.location):
+                    raise
+
+    @contextmanager
+    def lock(self, key):
+        """
+        Also locks a file next to the feeds, so other processes writing
+        the same channel wait for each other.
+        """
+        with self.get_lock(key):
+            if fcntl is None:
+                yield
+                return
+
+            self.ensure_location()
+            with open(os.path.join(self.location, '.%s.lock' % key), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_signature(self, name):
+        try:
+            stat = os.stat(os.path.join(self.location, name))
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def write(self, name, content, encoding):
+        self.ensure_location()
+        with tempfile.NamedTemporaryFile(dir=self.location, prefix='.tmp', delete=False) as f:
+            f.write(content)
+        os.chmod(f.name, 0o644)
+        os.rename(f.name, os.path.join(self.location, name))
+
+
+class S3FeedStorage(FeedStorage):
+    """
+    Uploads the files to an S3 compatible bucket. Set `endpoint_url` to use
+    another S3 compatible service, like a local MinIO server, or pass an
+    already configured boto3 `client`.
+    """
+    def __init__(self, bucket, prefix='', endpoint_url=None, cache_control='max-age=5', client=None,
+                 **client_options):
+        super(S3FeedStorage, self).__init__()
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise ImproperlyConfigured('S3FeedStorage requires the boto3 package.')
+            client = boto3.client('s3', endpoint_url=endpoint_url, **client_options)
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_control = cache_control
+        self.client = client
+
+    def get_key(self, name):
+        return '%s%s' % (self.prefix, name)
+
+    def get_remote_digest(self, name):
+        """
+        Returns the MD5 digest of the uploaded object, or None if it doesn't
+        exist. For single part uploads S3 uses it as the ETag.
+        """
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self.get_key(name))
+        except self.client.exceptions.ClientError:
+            return None
+        return response['ETag'].strip('"')
+
+    def save(self, name, content, encoding=None):
+        # After a restart, compare with what's in the bucket before uploading
+        if name not in self.digests:
+            self.digests[name] = (self.get_remote_digest(name), None)
+        return super(S3FeedStorage, self).save(name, content, encoding)
+
+    def write(self, name, content, encoding):
+        # A PUT replaces the object atomically
+        options = {
+            'Bucket': self.bucket,
+            'Key': self.get_key(name),
+            'Body': content,
+            'ContentType': 'application/javascript',
+            'CacheControl': self.cache_control,
+        }
+        if encoding:
+            options['ContentEncoding'] = encoding
+        self.client.put_object(**options)
+
+
+def get_storage():
+    """
+    Returns the configured feed storage.
+    """
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                storage_class = import_string(settings.CHAT_FEED_STORAGE)
+                _storage = storage_class(**settings.CHAT_FEED_STORAGE_OPTIONS)
+    return _storage
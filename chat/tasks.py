@@ -1,21 +1,49 @@
 import re
 import json
-import os
-import views as chat_views
-from chat.models import ChatChannel, ChatUser, ChatMessage
-from django.conf import settings
-from slackclient import SlackClient
+import metrics
+import publisher
+import workers
+from scheduler import scheduler
+from django.db import transaction
+from chat.directory import channels, directory
+from chat.models import ChatChannel, ChatMessage
+from chat.serializers import serialize_channel, serialize_message
+from chat.utils import bulk_update
+from slack import get_client
 
 CHAT_COMMENT_TAG = '&lt;#&gt;'
 
 
-def new_message(channel, data):
+def task(func):
+    """
+    Marks a function as a background task that can be queued with `.delay()`.
+    The first argument is the channel id, so tasks for a channel run in order.
+    """
+    func = metrics.timed_function('chat_task', task=func.__name__)(func)
+
+    def delay(*args, **kwargs):
+        workers.enqueue(func, args, kwargs)
+    func.delay = delay
+    return func
+
+
+def is_comment(data):
+    """
+    Messages starting with the CHAT_COMMENT_TAG aren't recorded.
+    """
     simple_text = data.get('text', '')
     comment_regex = r'^\s*{}'.format(CHAT_COMMENT_TAG)
-    if not re.match(comment_regex, simple_text):
-        user, c = ChatUser.objects.get_or_create(
-            user_id=data['user']
-        )
+    return re.match(comment_regex, simple_text) is not None
+
+
+@task
+def new_message(channel_id, data):
+    if not is_comment(data):
+        channel = ChatChannel.objects.get(channel_id=channel_id)
+        # The channel may have been archived since the event was queued
+        if channel.archived:
+            return
+        user = directory.get_or_create(data['user'])
         m = ChatMessage(
             data=json.dumps(data),
             user=user,
@@ -24,32 +52,45 @@ def new_message(channel, data):
         m.save()
 
 
-def update_message(data):
-    m = ChatMessage.objects.get(ts=data['message']['ts'])
+@task
+def update_message(channel_id, data):
+    try:
+        m = ChatMessage.objects.select_related('channel').get(
+            channel__channel_id=channel_id,
+            ts=data['message']['ts']
+        )
+    except ChatMessage.DoesNotExist:
+        # Comments and messages from before the channel was logged
+        return
+    if m.channel.archived:
+        return
     m.data = json.dumps(data['message'])
     m.save()
 
 
-def delete_message(data):
+@task
+def delete_message(channel_id, data):
     try:
-        m = ChatMessage.objects.get(ts=data['deleted_ts'])
+        m = ChatMessage.objects.select_related('channel').get(
+            channel__channel_id=channel_id,
+            ts=data['deleted_ts']
+        )
     except ChatMessage.DoesNotExist:
         m = None
-    if m:
+    if m and not m.channel.archived:
         m.live = False
         m.save()
 
 
 def post_slack_message(channel, text=None, attachments=None):
-    sc = SlackClient(settings.SLACK_BOT_TOKEN)
-    sc.api_call(
-      "chat.postMessage",
-      channel=channel,
+    get_client().post_message_async(
+      channel,
       text=text,
       attachments=attachments
     )
 
 
+@metrics.timed_function('chat_publish_json')
 def publish_json(channel_id):
     """
     Render and publish a JSON feed representation of a channel
@@ -58,11 +99,99 @@ def publish_json(channel_id):
     # Get the Channel obj
     channel = ChatChannel.objects.get(channel_id=channel_id)
 
-    # Get the JSON from the ChatJson and convert to JSONP
-    json_string = chat_views.ChatJson.as_string(channel)
-    jsonp_string = "%s(%s);" % ("callback", json_string)
+    # Re-render the whole feed from the database
+    feed = publisher.load_feed(channel)
+    publisher.write_feed(feed)
+
+
+def publish_channel(channel):
+    """
+    Update the channel metadata of an already rendered feed and schedule
+    it to be published.
+    """
+    publisher.update_feed(
+        channel,
+        lambda feed: feed.update_channel(channel),
+        [('channel', serialize_channel(channel))]
+    )
+    scheduler.schedule(channel.channel_id)
+
+
+def publish_message(message, created=False):
+    """
+    Apply a single added, edited or deleted message to its channel's
+    rendered feed and schedule it to be published.
+    """
+    if not message.live:
+        change = ('deleted', {'ts': message.ts})
+    else:
+        change = ('added' if created else 'changed', serialize_message(message))
+    if publisher.update_feed(message.channel, lambda feed: feed.update_message(message), [change]):
+        scheduler.schedule(message.channel.channel_id)
+
+
+def publish_users(users):
+    """
+    Refresh the feed representation of the live messages of users whose
+    display fields changed, and schedule their channels to be published
+    once the transaction commits.
+    """
+    messages = list(ChatMessage.messages.live().filter(
+        user__in=users,
+        channel__archived=False
+    ).select_related('user', 'channel'))
+    for message in messages:
+        message.update_feed_json()
+    bulk_update(messages, ['feed_json'])
+
+    by_channel = {}
+    for message in messages:
+        by_channel.setdefault(message.channel.channel_id, []).append(message)
+    # A publish before the commit would reload the feed from the old rows
+    transaction.on_commit(lambda: publish_messages(by_channel))
+
+
+def publish_messages(by_channel):
+    """
+    Apply the changed messages of each channel to its rendered feed and
+    schedule it to be published.
+    """
+    for channel_id, channel_messages in by_channel.items():
+        channel = channel_messages[0].channel
+        channel.touch()
+        publisher.update_feed(
+            channel,
+            lambda feed: [feed.update_message(message) for message in channel_messages],
+            [('changed', serialize_message(message)) for message in channel_messages]
+        )
+        scheduler.schedule(channel_id)
+
+
+def archive_channel(channel):
+    """
+    Freeze a channel: ignore its events from now on, save a final snapshot
+    of its feed for the API and publish its feed one last time.
+    """
+    ChatChannel.objects.filter(pk=channel.pk).update(archived=True)
+    channel.archived = True
+    channels.invalidate()
+
+    channel.snapshot = publisher.write_snapshot(channel)
+    ChatChannel.objects.filter(pk=channel.pk).update(snapshot=channel.snapshot)
+    channel.touch()
+
+    publish_json(channel.channel_id)
+    publisher.forget_feed(channel.channel_id)
+
+
+def unarchive_channel(channel):
+    """
+    Record the events of an archived channel again.
+    """
+    ChatChannel.objects.filter(pk=channel.pk).update(archived=False, snapshot='')
+    channel.archived = False
+    channel.snapshot = ''
+    channels.invalidate()
+    channel.touch()
 
-    # Used for development or small server load.
-    # Consider uploading to a server bucket instead for optimal performance.
-    with open(os.path.join(settings.ROOT_DIR, 'chat', '.json', '%s.jsonp' % channel_id), 'w') as f:
-        f.write(jsonp_string)
+    publish_json(channel.channel_id)
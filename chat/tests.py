@@ -0,0 +1,1148 @@
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+from SocketServer import ThreadingMixIn
+from unittest import skipUnless
+import requests
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext, captured_stdout
+from chat import broker, dedup, metrics, publisher, render, slack, storage, tasks, views
+from chat.broker import Broker, TooManyClients
+from chat.dedup import MemoryDedupStore
+from chat.directory import UserDirectory, channels, directory
+from chat.models import ChatChannel, ChatMessage, ChatUser
+from chat.publisher import save_file
+from chat.scheduler import PublishScheduler, scheduler
+from chat.slack import METHOD_TIERS, SlackWebClient, TokenBucket
+from chat.storage import LocalFeedStorage, S3FeedStorage
+from chat.views import ChatJson
+
+try:
+    import moto
+except ImportError:
+    moto = None
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    pass
+
+
+def create_channel(channel_id='C1'):
+    """
+    Creates a channel with bulk_create, which skips ChatChannel.save
+    and its Slack message and publish.
+    """
+    ChatChannel.objects.bulk_create([
+        ChatChannel(channel_id=channel_id, slug=channel_id.lower(), headline='Channel %s' % channel_id)
+    ])
+    return ChatChannel.objects.get(channel_id=channel_id)
+
+
+def create_messages(channel, count, users=5):
+    """
+    Creates `count` messages posted by a few users, without publishing.
+    """
+    authors = []
+    for i in range(users):
+        user, created = ChatUser.objects.get_or_create(
+            user_id='U%02d' % i,
+            defaults={'name': 'user%s' % i, 'real_name': 'User %s' % i}
+        )
+        authors.append(user)
+
+    messages = []
+    for i in range(count):
+        ts = '15000000%02d.%06d' % (i // 1000000, i % 1000000)
+        message = ChatMessage(
+            ts=ts,
+            data=json.dumps({'ts': ts, 'text': 'Message %s' % i, 'user': authors[i % users].user_id}),
+            html='<p>Message %s</p>' % i,
+            user=authors[i % users],
+            channel=channel
+        )
+        message.update_feed_json()
+        messages.append(message)
+    ChatMessage.objects.bulk_create(messages)
+
+
+class PublishingTestCase(TransactionTestCase):
+    """
+    Publishes the feeds right away to a temporary directory. The changes
+    are committed, so the publishes deferred until then happen.
+    """
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.previous_storage, storage._storage = storage._storage, LocalFeedStorage(self.location)
+        self.previous_window, scheduler.window = scheduler.window, 0
+        directory.invalidate()
+        channels.invalidate()
+
+    def tearDown(self):
+        scheduler.window = self.previous_window
+        storage._storage = self.previous_storage
+        publisher.forget_feed()
+        shutil.rmtree(self.location)
+
+    def get_published_feed(self, channel_id='C1', name='%s.jsonp'):
+        with open(os.path.join(self.location, name % channel_id)) as f:
+            return json.loads(f.read()[len('callback('):-len(');')])
+
+
+class ChatJsonQueriesTest(TestCase):
+    """
+    The feed is rendered in the same number of queries whatever the
+    number of messages.
+    """
+    # The channel's version for the ETag, the channel, then its messages
+    FEED_QUERIES = 3
+
+    def setUp(self):
+        self.channel = create_channel()
+
+    def get_feed(self, query=''):
+        response = self.client.get('/api/%s%s' % (self.channel.channel_id, query))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_feed_queries(self):
+        for count in (1, 50):
+            ChatMessage.objects.all().delete()
+            create_messages(self.channel, count)
+            with self.assertNumQueries(self.FEED_QUERIES):
+                feed = self.get_feed()
+            self.assertEqual(len(feed['messages']), count)
+            self.assertEqual(feed['messages'][0]['user']['display_name'], 'User %s' % ((count - 1) % 5))
+
+    def test_paginated_feed_queries(self):
+        for count in (1, 50):
+            ChatMessage.objects.all().delete()
+            create_messages(self.channel, count)
+            with self.assertNumQueries(self.FEED_QUERIES):
+                feed = self.get_feed('?limit=20')
+            self.assertEqual(len(feed['messages']), min(count, 20))
+
+    def test_as_string_queries(self):
+        for count in (1, 50):
+            ChatMessage.objects.all().delete()
+            create_messages(self.channel, count)
+            with self.assertNumQueries(1):
+                feed = json.loads(ChatJson.as_string(self.channel))
+            self.assertEqual(len(feed['messages']), count)
+
+
+class UserDirectoryTest(TestCase):
+    """
+    Mentions are looked up in the user cache, which remembers the ids
+    without a user for a while too.
+    """
+    def setUp(self):
+        create_messages(create_channel(), 1, users=2)
+        self.directory = UserDirectory(size=10, timeout=300, miss_timeout=60)
+
+    def test_mentioned_ids(self):
+        source = json.dumps({'text': 'Ask <@U00> or <@U01|user1> at bob@example.com, cc @here'})
+        self.assertEqual(render.get_mentioned_ids(source), set(['U00', 'U01']))
+
+    def test_missing(self):
+        self.assertEqual(sorted(self.directory.get_many(['U00', 'UNKNOWN'])), ['U00'])
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(self.directory.get_many(['U00', 'UNKNOWN'])), ['U00'])
+
+        # Looked up again once the miss expires
+        self.directory.missing['UNKNOWN'] = time.time()
+        with self.assertNumQueries(1):
+            self.directory.get_many(['UNKNOWN'])
+
+    def test_created(self):
+        self.assertIsNone(self.directory.get('UNEW'))
+        user = self.directory.get_or_create('UNEW')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.directory.get('UNEW'), user)
+
+        # Created by another process, then saved here
+        self.assertIsNone(self.directory.get('UOTHER'))
+        ChatUser.objects.create(user_id='UOTHER')
+        self.directory.invalidate('UOTHER')
+        self.assertEqual(self.directory.get('UOTHER').user_id, 'UOTHER')
+
+
+class PublishSchedulerTest(SimpleTestCase):
+    """
+    Bursts of publish requests are coalesced per channel by a single
+    scheduler thread.
+    """
+    def setUp(self):
+        self.published = []
+        self.done = threading.Event()
+        self.scheduler = PublishScheduler(self.publish, window=0.05, max_latency=0.2)
+
+    def publish(self, channel_id, first_requested):
+        self.published.append((channel_id, time.time() - first_requested))
+        self.done.set()
+
+    def test_burst(self):
+        threads = threading.active_count()
+        for i in range(50):
+            self.scheduler.schedule('C1')
+            self.scheduler.schedule('C2')
+        self.assertEqual(threading.active_count(), threads + 1)
+
+        time.sleep(0.2)
+        self.assertEqual(sorted(channel_id for channel_id, lag in self.published), ['C1', 'C2'])
+        self.assertEqual(self.scheduler.pending, {})
+
+    def test_max_latency(self):
+        start = time.time()
+        while not self.done.is_set() and time.time() - start < 1:
+            self.scheduler.schedule('C1')
+            time.sleep(0.01)
+
+        # Published while it was still requested every 10ms
+        [(channel_id, lag)] = self.published
+        self.assertGreaterEqual(lag, 0.2)
+        self.assertLess(lag, 0.3)
+
+    def test_flush_all(self):
+        self.scheduler.window = 10
+        self.scheduler.schedule('C1')
+        self.scheduler.flush_all()
+        self.assertEqual([channel_id for channel_id, lag in self.published], ['C1'])
+        self.assertEqual(self.scheduler.pending, {})
+
+
+class StubSlackClient(object):
+    """
+    Serves paged users.list fixtures like the Slack API, recording the
+    calls. Raises `fail_at` instead of serving the page with that index.
+    """
+    def __init__(self, pages, fail_at=None):
+        self.pages = pages
+        self.fail_at = fail_at
+        self.calls = []
+
+    def api_call(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        index = int(kwargs.get('cursor') or 0)
+        if index == self.fail_at:
+            raise IOError('Connection reset')
+        next_cursor = str(index + 1) if index + 1 < len(self.pages) else ''
+        return {
+            'ok': True,
+            'members': self.pages[index],
+            'response_metadata': {'next_cursor': next_cursor},
+        }
+
+
+def slack_user(user_id, real_name=None):
+    return {
+        'id': user_id,
+        'name': user_id.lower(),
+        'real_name': real_name or 'User %s' % user_id,
+        'profile': dict(('image_%s' % size, 'http://x/%s_%s.png' % (user_id, size)) for size in (24, 32, 48, 72, 192)),
+    }
+
+
+class UpdateUsersTest(TestCase):
+    """
+    updateusers pages through users.list, saving each page as it arrives.
+    """
+    PAGES = [
+        [slack_user('U01'), slack_user('U02')],
+        [slack_user('U03'), slack_user('U04')],
+        [slack_user('U05')],
+    ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'chat'))
+        self.settings_override = override_settings(ROOT_DIR=self.root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.root)
+
+    def run_command(self, client, *args):
+        from chat.management.commands.updateusers import Command
+        command = Command()
+        command.get_client = lambda: client
+        with captured_stdout():
+            call_command(command, *args)
+
+    def test_pages(self):
+        for args in ((), ('--bulk',)):
+            ChatUser.objects.all().delete()
+            client = StubSlackClient(self.PAGES)
+            self.run_command(client, '--page-size', '2', *args)
+
+            self.assertEqual(
+                sorted(ChatUser.objects.values_list('user_id', flat=True)),
+                ['U01', 'U02', 'U03', 'U04', 'U05']
+            )
+            self.assertEqual(
+                [(method, kwargs['cursor'], kwargs['limit']) for method, kwargs in client.calls],
+                [('users.list', None, 2), ('users.list', '1', 2), ('users.list', '2', 2)]
+            )
+
+    def test_updates(self):
+        self.run_command(StubSlackClient(self.PAGES))
+        pages = [[slack_user('U01', 'Renamed')]]
+        self.run_command(StubSlackClient(pages), '--bulk')
+        self.assertEqual(ChatUser.objects.get(user_id='U01').real_name, 'Renamed')
+
+    def test_commits_each_page(self):
+        client = StubSlackClient(self.PAGES, fail_at=2)
+        with self.assertRaises(IOError):
+            self.run_command(client, '--page-size', '2')
+
+        # The pages before the failure are saved, with the cursor of the next one
+        self.assertEqual(ChatUser.objects.count(), 4)
+        with open(os.path.join(self.root, 'chat', '.updateusers_cursor')) as f:
+            self.assertEqual(f.read(), '2')
+
+    def test_resume(self):
+        with self.assertRaises(IOError):
+            self.run_command(StubSlackClient(self.PAGES, fail_at=2), '--page-size', '2')
+
+        client = StubSlackClient(self.PAGES)
+        self.run_command(client, '--page-size', '2', '--resume')
+
+        self.assertEqual([kwargs['cursor'] for method, kwargs in client.calls], ['2'])
+        self.assertEqual(ChatUser.objects.count(), 5)
+        # The cursor is cleared once every page is done
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'chat', '.updateusers_cursor')))
+
+
+def hammer_storage(location, contents, rounds, threads=2):
+    """
+    Saves the contents to the same channel's file over and over from
+    a few threads. Runs in the writer processes.
+    """
+    storage = LocalFeedStorage(location)
+
+    def write(offset):
+        for i in range(rounds):
+            with storage.lock('C1'):
+                storage.save('C1.jsonp', contents[(offset + i) % len(contents)])
+
+    writers = [threading.Thread(target=write, args=(offset,)) for offset in range(threads)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+
+
+class LocalFeedStorageTest(SimpleTestCase):
+    """
+    Readers only ever see complete files while many writers replace them.
+    """
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        # Feeds of very different sizes, so a partial file can't match
+        self.contents = [
+            'callback(%s);' % json.dumps({'writer': i, 'messages': ['message %s' % i] * (i * 2000)})
+            for i in range(8)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def read_while(self, writers):
+        """
+        Reads the file until the writers are done and returns how many
+        complete reads were made.
+        """
+        path = os.path.join(self.location, 'C1.jsonp')
+        contents = set(self.contents)
+        reads = 0
+        while any(writer.is_alive() for writer in writers):
+            try:
+                with open(path) as f:
+                    content = f.read()
+            except IOError:
+                continue
+            self.assertIn(content, contents)
+            reads += 1
+        return reads
+
+    def check_writers(self, writers):
+        for writer in writers:
+            writer.start()
+        readers = ThreadPool(4)
+        try:
+            reads = readers.map(lambda i: self.read_while(writers), range(4))
+        finally:
+            readers.close()
+            readers.join()
+        for writer in writers:
+            writer.join()
+
+        self.assertGreater(sum(reads), 0)
+        # No temporary file is left behind
+        self.assertEqual(sorted(os.listdir(self.location)), ['.C1.lock', 'C1.jsonp'])
+
+    def test_concurrent_threads(self):
+        self.check_writers([
+            threading.Thread(target=hammer_storage, args=(self.location, self.contents, 50, 1))
+            for i in range(8)
+        ])
+
+    def test_concurrent_processes(self):
+        self.check_writers([
+            multiprocessing.Process(target=hammer_storage, args=(self.location, self.contents, 25))
+            for i in range(8)
+        ])
+
+    def test_unchanged(self):
+        storage = LocalFeedStorage(self.location)
+        self.assertTrue(storage.save('C1.jsonp', self.contents[0]))
+        self.assertFalse(storage.save('C1.jsonp', self.contents[0]))
+
+        # Replaced by another process, so written again
+        time.sleep(0.01)
+        LocalFeedStorage(self.location).save('C1.jsonp', self.contents[1])
+        self.assertTrue(storage.save('C1.jsonp', self.contents[0]))
+
+
+class FakeS3Client(object):
+    """
+    An in-memory stand-in for a boto3 S3 client.
+    """
+    class exceptions(object):
+        class ClientError(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.ClientError('Not Found')
+        return {'ETag': '"%s"' % hashlib.md5(self.objects[Bucket, Key]['Body']).hexdigest()}
+
+    def put_object(self, **options):
+        self.objects[options['Bucket'], options['Key']] = options
+        self.puts.append(options['Key'])
+
+
+class S3FeedStorageTest(SimpleTestCase):
+    """
+    The S3 backend uploads the files and their compressed variants
+    only when they changed.
+    """
+    def test_upload(self):
+        client = FakeS3Client()
+        storage = S3FeedStorage('feeds', prefix='chat/', client=client)
+        save_file(storage, 'C1.jsonp', 'callback({});')
+
+        self.assertEqual(client.puts, ['chat/C1.jsonp', 'chat/C1.jsonp.gz'])
+        uploaded = client.objects['feeds', 'chat/C1.jsonp']
+        self.assertEqual(uploaded['Body'], 'callback({});')
+        self.assertEqual(uploaded['ContentType'], 'application/javascript')
+        self.assertNotIn('ContentEncoding', uploaded)
+        compressed = client.objects['feeds', 'chat/C1.jsonp.gz']
+        self.assertEqual(compressed['ContentEncoding'], 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(compressed['Body'])).read(), 'callback({});')
+
+    def test_unchanged(self):
+        client = FakeS3Client()
+        storage = S3FeedStorage('feeds', client=client)
+        self.assertTrue(storage.save('C1.jsonp', 'callback({});'))
+        self.assertFalse(storage.save('C1.jsonp', 'callback({});'))
+
+        # After a restart, the uploaded object is compared by its ETag
+        storage = S3FeedStorage('feeds', client=client)
+        self.assertFalse(storage.save('C1.jsonp', 'callback({});'))
+        self.assertTrue(storage.save('C1.jsonp', 'callback({"a": 1});'))
+        self.assertEqual(client.puts, ['C1.jsonp', 'C1.jsonp'])
+
+    @skipUnless(moto, 'Requires the moto package.')
+    def test_moto(self):
+        import boto3
+        with moto.mock_s3():
+            client = boto3.client('s3', region_name='us-east-1')
+            client.create_bucket(Bucket='feeds')
+            storage = S3FeedStorage('feeds', region_name='us-east-1')
+            self.assertTrue(storage.save('C1.jsonp', 'callback({});'))
+            self.assertFalse(S3FeedStorage('feeds', region_name='us-east-1').save('C1.jsonp', 'callback({});'))
+            body = client.get_object(Bucket='feeds', Key='C1.jsonp')['Body'].read()
+            self.assertEqual(body, 'callback({});')
+
+
+class ChatStreamLimitTest(TestCase):
+    """
+    Each process streams to at most CHAT_STREAM_MAX_CLIENTS clients.
+    """
+    def setUp(self):
+        create_channel()
+        self.broker = Broker(history_size=10, client_queue_size=10, max_clients=2)
+        self.previous_broker, broker._broker = broker._broker, self.broker
+
+    def tearDown(self):
+        broker._broker = self.previous_broker
+
+    def test_broker_limit(self):
+        first, backlog = self.broker.subscribe('C1')
+        self.broker.subscribe('C2')
+        with self.assertRaises(TooManyClients):
+            self.broker.subscribe('C1')
+
+        self.broker.unsubscribe(first)
+        self.broker.unsubscribe(first)
+        self.assertEqual(self.broker.clients, 1)
+        self.broker.subscribe('C1')
+
+    def test_503(self):
+        responses = [self.client.get('/stream/C1') for i in range(3)]
+        self.assertEqual([r.status_code for r in responses], [200, 200, 503])
+        self.assertEqual(responses[2]['Retry-After'], str(settings.CHAT_STREAM_RETRY))
+
+        # Closing a response frees its slot, even if it was never read
+        responses[0].close()
+        self.assertEqual(self.broker.clients, 1)
+        self.assertEqual(self.client.get('/stream/C1').status_code, 200)
+
+
+class FeedChangesTest(PublishingTestCase):
+    """
+    Every change reaches the delta file and the stream, including the
+    first one after the feed was dropped from the cache.
+    """
+    def setUp(self):
+        super(FeedChangesTest, self).setUp()
+        self.broker = Broker(history_size=3, client_queue_size=10)
+        self.previous_broker, broker._broker = broker._broker, self.broker
+        create_channel()
+
+    def tearDown(self):
+        broker._broker = self.previous_broker
+        super(FeedChangesTest, self).tearDown()
+
+    def new_message(self, i):
+        tasks.new_message('C1', {'type': 'message', 'user': 'U01', 'text': 'Message %s' % i, 'ts': '150000000%s.000000' % i})
+
+    def get_changes(self):
+        return [
+            (change['action'], change['data']['ts'])
+            for change in self.get_published_feed(name='%s.delta.jsonp')['changes']
+        ]
+
+    def test_cold_cache(self):
+        subscription, backlog = self.broker.subscribe('C1')
+        self.new_message(0)
+        self.new_message(1)
+        expected = [('added', '1500000000.000000'), ('added', '1500000001.000000')]
+        self.assertEqual(self.get_changes(), expected)
+        self.assertEqual([(e['action'], e['data']['ts']) for e in list(subscription.queue.queue)], expected)
+
+        # Dropped from the cache, like after a restart
+        publisher.forget_feed()
+        message = ChatMessage.objects.get(ts='1500000000.000000')
+        message.live = False
+        message.save()
+        self.assertEqual(self.get_changes()[-1], ('deleted', '1500000000.000000'))
+        self.assertEqual(list(subscription.queue.queue)[-1]['action'], 'deleted')
+
+    def read_stream(self, last_event_id, count):
+        """
+        Returns the first `count` events of a stream resumed after
+        `last_event_id`.
+        """
+        response = self.client.get('/stream/C1', HTTP_LAST_EVENT_ID=last_event_id)
+        try:
+            return [next(response.streaming_content) for i in range(count)]
+        finally:
+            response.close()
+
+    def test_resume(self):
+        for i in range(3):
+            self.new_message(i)
+        history = list(self.broker.history['C1'])
+
+        retry, event = self.read_stream(history[1]['ts'], 2)
+        self.assertEqual(retry, 'retry: %d\n\n' % (settings.CHAT_STREAM_RETRY * 1000))
+        self.assertEqual(event, 'id: %s\nevent: added\ndata: %s\n\n' % (
+            history[2]['ts'],
+            json.dumps(history[2]['data'])
+        ))
+        self.assertEqual(self.broker.clients, 0)
+
+    def test_reset(self):
+        self.new_message(0)
+        last_event_id = self.broker.history['C1'][0]['ts']
+        for i in range(1, 5):
+            self.new_message(i)
+
+        # The change after it fell out of the history
+        retry, reset = self.read_stream(last_event_id, 2)
+        self.assertEqual(reset, 'event: reset\ndata: {}\n\n')
+        self.assertEqual(self.broker.clients, 0)
+
+
+class MemoryDedupStoreTest(SimpleTestCase):
+    """
+    Event ids are remembered for the window, at most `size` of them.
+    """
+    def test_window(self):
+        store = MemoryDedupStore(window=0.05, size=10)
+        self.assertTrue(store.add('Ev1'))
+        self.assertFalse(store.add('Ev1'))
+        time.sleep(0.06)
+        self.assertTrue(store.add('Ev1'))
+
+    def test_size(self):
+        store = MemoryDedupStore(window=600, size=3)
+        for event_id in ('Ev1', 'Ev2', 'Ev3', 'Ev4'):
+            self.assertTrue(store.add(event_id))
+        self.assertEqual(list(store.seen), ['Ev2', 'Ev3', 'Ev4'])
+        self.assertFalse(store.add('Ev4'))
+        self.assertTrue(store.add('Ev1'))
+
+    def test_counts(self):
+        store = MemoryDedupStore(window=600, size=10)
+        self.assertTrue(store.check('Ev1'))
+        self.assertFalse(store.check('Ev1', retry_num='1'))
+        self.assertTrue(store.check('Ev2', retry_num='1'))
+        self.assertFalse(store.check('Ev2'))
+        self.assertEqual(store.stats(), {
+            'events': 4,
+            'duplicates': 2,
+            'retries': 2,
+            'retries_absorbed': 1,
+        })
+
+
+@override_settings(SLACK_VERIFICATION_TOKEN='token')
+class SlackEventWebhookTest(TestCase):
+    """
+    Events Slack delivers again are acknowledged without queuing a task.
+    """
+    def setUp(self):
+        create_channel()
+        channels.invalidate()
+        self.previous_store, dedup._store = dedup._store, MemoryDedupStore(window=600, size=10)
+        self.queued = []
+        self.previous_delay = tasks.new_message.delay
+        tasks.new_message.delay = lambda *args: self.queued.append(args)
+
+    def tearDown(self):
+        tasks.new_message.delay = self.previous_delay
+        dedup._store = self.previous_store
+
+    def post_event(self, event_id, **extra):
+        payload = {
+            'token': 'token',
+            'type': 'event_callback',
+            'event_id': event_id,
+            'event': {'type': 'message', 'channel': 'C1', 'user': 'U01', 'text': 'Hi', 'ts': '1500000000.000000'},
+        }
+        return self.client.post('/slack/', json.dumps(payload), content_type='application/json', **extra)
+
+    def test_retry(self):
+        self.assertEqual(self.post_event('Ev1').status_code, 200)
+        self.assertEqual(len(self.queued), 1)
+
+        response = self.post_event('Ev1', HTTP_X_SLACK_RETRY_NUM='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.queued), 1)
+        self.assertEqual(dedup._store.stats()['retries_absorbed'], 1)
+
+        self.assertEqual(self.post_event('Ev2').status_code, 200)
+        self.assertEqual(len(self.queued), 2)
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    """
+    Answers each Web API call with the next queued response of the server.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        self.server.requests.append({
+            'method': self.path.rsplit('/', 1)[-1],
+            'data': data,
+            'time': time.time(),
+            'port': self.client_address[1],
+        })
+        if self.server.responses:
+            status, headers, body = self.server.responses.pop(0)
+        else:
+            status, headers, body = 200, {}, {'ok': True}
+
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class SlackClientTest(SimpleTestCase):
+    """
+    The Slack client against a local fake of the Web API.
+    """
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSlackHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.responses = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = SlackWebClient('xoxb-test', api_url='http://127.0.0.1:%s/api/' % self.server.server_port)
+
+        self.log = []
+        self.log_handler = logging.Handler()
+        self.log_handler.emit = self.log.append
+        logging.getLogger('chat.slack').addHandler(self.log_handler)
+
+    def tearDown(self):
+        logging.getLogger('chat.slack').removeHandler(self.log_handler)
+        self.client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_api_call(self):
+        response = self.client.api_call('users.list', limit=2, cursor=None)
+        self.assertEqual(response, {'ok': True})
+        self.assertEqual(self.server.requests[0]['method'], 'users.list')
+        self.assertEqual(self.server.requests[0]['data'], {'token': 'xoxb-test', 'limit': '2'})
+
+    def test_keep_alive(self):
+        for i in range(3):
+            self.client.api_call('chat.postMessage', channel='C1', text='Message %s' % i)
+        self.assertEqual(len(set(r['port'] for r in self.server.requests)), 1)
+
+    def test_retry_after(self):
+        self.server.responses = [(429, {'Retry-After': '1'}, {'ok': False, 'error': 'ratelimited'})]
+        response = self.client.api_call('conversations.history', channel='C1')
+
+        self.assertEqual(response, {'ok': True})
+        first, second = self.server.requests
+        self.assertGreaterEqual(second['time'] - first['time'], 1)
+        self.assertEqual(len(self.log), 1)
+
+    def test_retries_exhausted(self):
+        self.client.max_retries = 2
+        self.server.responses = [(429, {'Retry-After': '0'}, {'ok': False, 'error': 'ratelimited'})] * 3
+        response = self.client.api_call('conversations.history', channel='C1')
+
+        self.assertEqual(response, {'ok': False, 'error': 'ratelimited'})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_pacing(self):
+        # 20 calls per second, in bursts of 2
+        self.client.buckets[METHOD_TIERS['users.list']] = TokenBucket(20, 2)
+        start = time.time()
+        for i in range(8):
+            self.client.api_call('users.list')
+
+        # The burst goes through at once, then one call every 50ms
+        times = [r['time'] - start for r in self.server.requests]
+        self.assertLess(times[1], 0.05)
+        self.assertGreaterEqual(times[-1], 0.29)
+        for before, after in zip(times[2:], times[3:]):
+            self.assertGreater(after - before, 0.03)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=50, capacity=5)
+        start = time.time()
+        for i in range(15):
+            bucket.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.19)
+
+    def test_post_message_async(self):
+        results = [self.client.post_message_async('C1', text='Message %s' % i) for i in range(5)]
+        self.assertEqual([r.get(5) for r in results], [{'ok': True}] * 5)
+        self.assertEqual(
+            sorted(r['data']['text'] for r in self.server.requests),
+            ['Message %s' % i for i in range(5)]
+        )
+
+    def test_post_message_async_errors(self):
+        self.server.responses = [(200, {}, {'ok': False, 'error': 'channel_not_found'})]
+        self.client.post_message_async('C1', text='Lost').get(5)
+        self.assertIn('channel_not_found', self.log[-1].getMessage())
+
+        # Network errors are logged too
+        self.client.api_url = 'http://127.0.0.1:1/api/'
+        result = self.client.post_message_async('C1', text='Lost')
+        with self.assertRaises(requests.ConnectionError):
+            result.get(5)
+        self.assertIn('Could not post a message to C1', self.log[-1].getMessage())
+
+
+class StubHistoryClient(object):
+    """
+    Serves a channel's history in pages like conversations.history.
+    """
+    def __init__(self, messages):
+        self.messages = messages
+
+    def api_call(self, method, channel, limit, cursor=None, oldest=None, latest=None):
+        start = int(cursor or 0)
+        end = min(start + limit, len(self.messages))
+        return {
+            'ok': True,
+            'messages': self.messages[start:end],
+            'has_more': end < len(self.messages),
+            'response_metadata': {'next_cursor': str(end) if end < len(self.messages) else ''},
+        }
+
+
+class BackfillChannelTest(PublishingTestCase):
+    """
+    backfillchannel imports the missing messages of a channel's history.
+    """
+    def setUp(self):
+        super(BackfillChannelTest, self).setUp()
+        self.channel = create_channel()
+        self.messages = [
+            {'type': 'message', 'user': 'U%02d' % (i % 3), 'text': 'Message %s' % i, 'ts': '15000000%02d.000000' % i}
+            for i in range(25)
+        ]
+        self.previous_client, slack._client = slack._client, StubHistoryClient(self.messages)
+
+    def tearDown(self):
+        slack._client = self.previous_client
+        super(BackfillChannelTest, self).tearDown()
+
+    def run_command(self, command, *args):
+        with captured_stdout():
+            call_command(command, *args)
+
+    def test_backfill(self):
+        create_messages(self.channel, 1)
+        version = ChatChannel.objects.get().version
+        self.run_command('backfillchannel', 'C1', '--page-size', '10')
+
+        self.assertEqual(ChatMessage.objects.count(), 25)
+        self.assertEqual(len(self.get_published_feed()['messages']), 25)
+        # Bumped once per page saved
+        self.assertEqual(ChatChannel.objects.get().version, version + 3)
+
+    def test_conflicts(self):
+        from chat.management.commands.backfillchannel import Command
+
+        class ConflictingCommand(Command):
+            def build_messages(self, channel, messages):
+                new_messages = super(ConflictingCommand, self).build_messages(channel, messages)
+                # A live event inserts one of them after they were checked
+                if not ChatMessage.objects.exists():
+                    create_messages(channel, 1)
+                return new_messages
+
+        self.run_command(ConflictingCommand(), 'C1', '--page-size', '10')
+        self.assertEqual(ChatMessage.objects.count(), 25)
+        self.assertEqual(len(self.get_published_feed()['messages']), 25)
+
+
+class StaleFeedTest(PublishingTestCase):
+    """
+    A feed cached by another process before a bulk change doesn't
+    write the change back out of the published file.
+    """
+    def setUp(self):
+        super(StaleFeedTest, self).setUp()
+        self.channel = create_channel()
+        create_messages(self.channel, 10)
+        ChatMessage.objects.update(html='<p>Old</p>', html_hash='')
+        for message in ChatMessage.objects.select_related('user'):
+            message.update_feed_json()
+            ChatMessage.objects.filter(pk=message.pk).update(feed_json=message.feed_json)
+
+    def get_stale_feed(self):
+        """
+        Returns the feed as another process would have cached it now.
+        """
+        channel = ChatChannel.objects.get()
+        return publisher.ChannelFeed(
+            channel,
+            ChatMessage.messages.live().filter(channel=channel).values_list('ts', 'feed_json')
+        )
+
+    def test_rerenderhtml(self):
+        stale = self.get_stale_feed()
+        with captured_stdout():
+            call_command('rerenderhtml', '--workers', '2', '--batch-size', '4')
+        self.assertNotIn('Old', self.get_published_feed()['messages'][0]['html'])
+
+        publisher.cache_feed(stale)
+        publisher.write_channel('C1')
+        self.assertEqual(
+            set(m['html'] for m in self.get_published_feed()['messages']),
+            set('<p>Message %s</p>' % i for i in range(10))
+        )
+
+    def test_rerenderhtml_live_edit(self):
+        from chat.management.commands.rerenderhtml import Command
+
+        class EditedCommand(Command):
+            def save(self, stale, rendered):
+                # A live edit lands while the batch is rendered
+                message = ChatMessage.objects.get(pk=stale[0][0].pk)
+                if not message.override_text:
+                    message.override_text = 'Edited'
+                    message.save()
+                return super(EditedCommand, self).save(stale, rendered)
+
+        with captured_stdout():
+            call_command(EditedCommand(), '--workers', '2', '--batch-size', '4')
+        self.assertEqual(ChatMessage.objects.filter(html='<p>Edited</p>').count(), 3)
+        self.assertEqual(ChatMessage.objects.filter(html__contains='Old').count(), 0)
+        self.assertEqual(
+            len([m for m in self.get_published_feed()['messages'] if m['html'] == '<p>Edited</p>']),
+            3
+        )
+
+    def test_publish_users(self):
+        stale = self.get_stale_feed()
+        user = ChatUser.objects.get(user_id='U01')
+        user.real_name = 'Renamed'
+        user.save()
+
+        # A change in the process with the stale feed
+        publisher.cache_feed(stale)
+        message = ChatMessage.objects.get(ts=ChatMessage.objects.order_by('ts')[0].ts)
+        message.override_text = 'Edited'
+        message.save()
+
+        messages = self.get_published_feed()['messages']
+        self.assertEqual(len([m for m in messages if m['user']['display_name'] == 'Renamed']), 2)
+        self.assertIn('Edited', messages[-1]['html'])
+
+    def test_publish_users_on_commit(self):
+        user = ChatUser.objects.get(user_id='U01')
+        user.real_name = 'Renamed'
+        with transaction.atomic():
+            user.save()
+            self.assertEqual(publisher.get_version('C1'), self.channel.version)
+            self.assertFalse(os.path.exists(os.path.join(self.location, 'C1.jsonp')))
+
+        names = [m['user']['display_name'] for m in self.get_published_feed()['messages']]
+        self.assertEqual(names.count('Renamed'), 2)
+
+    def test_stale_directory(self):
+        # Cached before another process renamed the user
+        self.assertEqual(directory.get('U01').display_name, 'User 1')
+        ChatUser.objects.filter(user_id='U01').update(real_name='Renamed')
+
+        tasks.new_message('C1', {'type': 'message', 'user': 'U01', 'text': 'New', 'ts': '1600000000.000000'})
+        self.assertEqual(self.get_published_feed()['messages'][0]['user']['display_name'], 'Renamed')
+
+
+class MetricsQueriesTest(TestCase):
+    """
+    Counting the queries of the timed sections is opt-in and leaves
+    the query log of other readers alone.
+    """
+    def setUp(self):
+        metrics.registry.metrics.pop('chat_test_queries', None)
+
+    def run_section(self):
+        with metrics.timed('chat_test'):
+            ChatChannel.objects.count()
+        return metrics.registry.metrics['chat_test_queries'].values.get(())
+
+    def test_disabled(self):
+        self.assertFalse(settings.CHAT_METRICS_COUNT_QUERIES)
+        self.run_section()
+        self.assertFalse(connection.force_debug_cursor)
+        self.assertIsNone(metrics.registry.metrics['chat_test_queries'].values.get(()))
+
+    @override_settings(CHAT_METRICS_COUNT_QUERIES=True)
+    def test_count(self):
+        buckets, total, count = self.run_section()
+        self.assertEqual((total, count), (1, 1))
+        self.assertFalse(connection.force_debug_cursor)
+
+    @override_settings(CHAT_METRICS_COUNT_QUERIES=True)
+    def test_capture_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(connection.queries_limit):
+                connection.queries_log.append({'sql': 'SELECT %s' % i, 'time': '0'})
+            self.run_section()
+        self.assertEqual(len(queries.captured_queries), connection.queries_limit)
+
+
+class ArchivedChannelTasksTest(PublishingTestCase):
+    """
+    The tasks ignore the events of archived channels by checking the
+    database, not the cached ids of the logged channels.
+    """
+    def setUp(self):
+        super(ArchivedChannelTasksTest, self).setUp()
+        # Loaded before the channel existed, like in a worker process
+        channels.load()
+        self.channel = create_channel()
+
+    def message(self, ts, text):
+        return {'type': 'message', 'user': 'U01', 'text': text, 'ts': ts}
+
+    def test_new_channel(self):
+        self.assertFalse(channels.is_logged('C1'))
+        tasks.new_message('C1', self.message('1500000000.000000', 'First'))
+        self.assertEqual(ChatMessage.objects.get().html, '<p>First</p>')
+
+    def test_archived(self):
+        tasks.new_message('C1', self.message('1500000000.000000', 'First'))
+        ChatChannel.objects.update(archived=True)
+
+        tasks.new_message('C1', self.message('1500000001.000000', 'Second'))
+        tasks.update_message('C1', {'message': self.message('1500000000.000000', 'Edited')})
+        tasks.delete_message('C1', {'deleted_ts': '1500000000.000000'})
+
+        message = ChatMessage.objects.get()
+        self.assertEqual((message.html, message.live), ('<p>First</p>', True))
+
+    def test_unknown_message(self):
+        tasks.update_message('C1', {'message': self.message('1500000000.000000', 'Edited')})
+        tasks.delete_message('C1', {'deleted_ts': '1500000000.000000'})
+        self.assertFalse(ChatMessage.objects.exists())
+
+
+class ServingTestCase(PublishingTestCase):
+    """
+    Serves the feeds published to the temporary directory from /json/.
+    """
+    def setUp(self):
+        super(ServingTestCase, self).setUp()
+        self.previous_root, views.JSON_ROOT = views.JSON_ROOT, self.location
+        self.channel = create_channel()
+        create_messages(self.channel, 3)
+
+    def tearDown(self):
+        views.JSON_ROOT = self.previous_root
+        super(ServingTestCase, self).tearDown()
+
+
+class ConditionalRequestsTest(ServingTestCase):
+    """
+    The API and the published files answer 304 when the client has the
+    latest version.
+    """
+    def setUp(self):
+        super(ConditionalRequestsTest, self).setUp()
+        publisher.write_channel('C1')
+
+    def get(self, path, **headers):
+        response = self.client.get(path, **headers)
+        response.close()
+        return response
+
+    def test_if_none_match(self):
+        for path in ('/api/C1', '/json/C1.jsonp'):
+            etag = self.get(path)['ETag']
+            self.assertEqual(self.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.get(path, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_if_modified_since(self):
+        for path in ('/api/C1', '/json/C1.jsonp'):
+            last_modified = self.get(path)['Last-Modified']
+            self.assertEqual(self.get(path, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+            self.assertEqual(
+                self.get(path, HTTP_IF_MODIFIED_SINCE='Mon, 01 Jan 2001 00:00:00 GMT').status_code,
+                200
+            )
+
+    def test_changed(self):
+        etags = dict((path, self.get(path)['ETag']) for path in ('/api/C1', '/json/C1.jsonp'))
+        tasks.new_message('C1', {'type': 'message', 'user': 'U01', 'text': 'New', 'ts': '1600000000.000000'})
+
+        for path, etag in etags.items():
+            response = self.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+
+class EncodingNegotiationTest(ServingTestCase):
+    """
+    The published files are served precompressed to the clients that
+    accept it.
+    """
+    def setUp(self):
+        super(EncodingNegotiationTest, self).setUp()
+        publisher.write_channel('C1')
+        with open(os.path.join(self.location, 'C1.jsonp')) as f:
+            self.content = f.read()
+
+    def get(self, accept_encoding):
+        response = self.client.get('/json/C1.jsonp', HTTP_ACCEPT_ENCODING=accept_encoding)
+        content = ''.join(response.streaming_content)
+        response.close()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        return response, content
+
+    def test_gzip(self):
+        response, content = self.get('deflate, gzip;q=0.8')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        # The type of the file, not of the compressed variant
+        self.assertEqual(response['Content-Type'], self.get('')[0]['Content-Type'])
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(content)).read(), self.content)
+
+    def test_refused(self):
+        for accept_encoding in ('gzip;q=0', 'GZIP;q=0.0, identity', ''):
+            response, content = self.get(accept_encoding)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(content, self.content)
+
+    def test_identity_fallback(self):
+        # Not compressed, like the files published before the variants were
+        for name in os.listdir(self.location):
+            if name.endswith('.gz'):
+                os.remove(os.path.join(self.location, name))
+        response, content = self.get('gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(content, self.content)
+
+
+class ArchivedChannelApiTest(ServingTestCase):
+    """
+    The API redirects to the snapshot of an archived channel, which can
+    be cached forever, while the redirect itself can't.
+    """
+
+    def test_redirect(self):
+        self.channel.archive()
+        response = self.client.get('/api/C1')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], '/json/%s' % ChatChannel.objects.get().snapshot)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=%s' % settings.CHAT_ARCHIVE_REDIRECT_MAX_AGE)
+
+        snapshot = self.client.get(response['Location'])
+        self.assertEqual(snapshot.status_code, 200)
+        self.assertIn('immutable', snapshot['Cache-Control'])
+        self.assertEqual(len(json.loads(''.join(snapshot.streaming_content))['messages']), 3)
+
+        # Pages are still read from the database
+        self.assertEqual(self.client.get('/api/C1?limit=2').status_code, 200)
+
+    def test_unarchive(self):
+        self.channel.archive()
+        self.channel.unarchive()
+        response = self.client.get('/api/C1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['messages']), 3)
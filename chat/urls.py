@@ -1,7 +1,4 @@
-import os
-from django.conf import settings
 from django.contrib import admin
-from django.views.static import serve
 from chat import views as chat_views
 from django.conf.urls import include, url
 
@@ -29,14 +26,21 @@ urlpatterns = [
         chat_views.ChatJson.as_view(),
         name='chat_api'
     ),
+    url(
+        r'^stream/(?P<channel>.*)$',
+        chat_views.ChatStream.as_view(),
+        name='chat_stream'
+    ),
+
+    #
+    # Metrics
+    #
+    url(r'^metrics$', chat_views.metrics_view, name='chat_metrics'),
 
     #
     # Local JSONP
     #
-    url(r'^json/(?P<path>.*)$', serve, {
-        'document_root': os.path.join(settings.ROOT_DIR, 'chat', '.json'),
-        'show_indexes': True,
-    })
+    url(r'^json/(?P<path>.*)$', chat_views.serve_json, name='chat_json')
 ]
 
 
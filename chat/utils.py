@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+from django.db import connections, router
+
+
+def chunks(items, size):
+    """
+    Splits a list into lists of at most `size` items.
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def bulk_update(objs, fields, batch_size=500):
+    """
+    Saves the given fields of many objects of the same model with a single
+    UPDATE query per batch, using a CASE on the primary key.
+
+    The query is written by hand, building it with Case and When expressions
+    costs more than running it once there are a few hundred objects.
+    """
+    if not objs:
+        return
+    model = objs[0].__class__
+    meta = model._meta
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    pk_column = qn(meta.pk.column)
+    # Each object takes two parameters per field and one for the IN clause
+    batch_size = min(batch_size, connection.ops.bulk_batch_size([None] * (2 * len(fields) + 1), objs))
+
+    for batch in chunks(objs, batch_size):
+        pks = [meta.pk.get_db_prep_value(obj.pk, connection) for obj in batch]
+        assignments = []
+        params = []
+        for name in fields:
+            field = meta.get_field(name)
+            assignments.append('%s = CASE %s %s END' % (
+                qn(field.column),
+                pk_column,
+                ' '.join(['WHEN %s THEN %s'] * len(batch))
+            ))
+            for pk, obj in zip(pks, batch):
+                params.extend([pk, field.get_db_prep_save(getattr(obj, field.attname), connection)])
+        sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(meta.db_table),
+            ', '.join(assignments),
+            pk_column,
+            ', '.join(['%s'] * len(batch))
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + pks)
+
+
+class LRUCache(object):
+    """
+    A thread-safe dict that keeps only the `size` most recently used keys.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
@@ -1,12 +1,69 @@
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import time
+from datetime import datetime
+from django.conf import settings
 from django.views.generic import View
+from chat import metrics
+from chat.broker import TooManyClients, get_broker
+from chat.compression import ENCODINGS, get_accepted_encodings
 from chat.models import ChatChannel, ChatMessage
-from django.http import JsonResponse
-from django.test.client import RequestFactory
-from django.utils.decorators import classonlymethod
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseRedirect, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.decorators import classonlymethod, method_decorator
+from django.utils.timezone import utc
+from django.views.decorators.http import condition
+from django.views.static import serve
 from django.views.generic.detail import SingleObjectMixin
 from django.views.decorators.csrf import csrf_exempt
 from django.http import Http404
 from events import SlackEventHandler
+from serializers import iter_channel_feed
+
+TS_REGEX = re.compile(r'^\d+(\.\d+)?$')
+
+# Snapshots of archived channels are named after a hash of their content
+SNAPSHOT_REGEX = re.compile(r'^[\w-]+\.[0-9a-f]{16}\.json(\.\w+)?$')
+
+# Where the LocalFeedStorage publishes the feeds by default
+JSON_ROOT = settings.CHAT_FEED_STORAGE_OPTIONS.get(
+    'location',
+    os.path.join(settings.ROOT_DIR, 'chat', '.json')
+)
+
+
+def get_channel_version(request, channel):
+    """
+    Returns the version, last change and snapshot of a channel, once per
+    request.
+    """
+    if not hasattr(request, 'chat_channel_version'):
+        request.chat_channel_version = ChatChannel.objects.filter(
+            channel_id=channel
+        ).values_list('version', 'last_modified', 'snapshot').first()
+    return request.chat_channel_version
+
+
+def channel_etag(request, channel):
+    version = get_channel_version(request, channel)
+    if version:
+        return hashlib.md5('%s|%s|%s' % (
+            version[0],
+            version[1].isoformat(),
+            request.META.get('QUERY_STRING', '')
+        )).hexdigest()
+
+
+def channel_last_modified(request, channel):
+    version = get_channel_version(request, channel)
+    if version:
+        return version[1]
 
 
 class SlackEventWebhook(SingleObjectMixin, View):
@@ -26,61 +83,279 @@ class SlackEventWebhook(SingleObjectMixin, View):
 class ChatJson(View):
     """
     Local JSON feed for a particular Chat channel and its messages.
+
+    Accepts these optional query parameters:
+
+    - `since_ts`: only messages posted after this ts. With a `limit`, the
+      oldest messages after it are returned and `next_cursor` is the
+      `since_ts` of the following page.
+    - `before_ts`: only messages posted before this ts. With a `limit`,
+      the newest messages before it are returned and `next_cursor` is the
+      `before_ts` of the following page.
+    - `limit`: the maximum number of messages returned.
     """
     @classonlymethod
+    @metrics.timed_function('chat_feed_render')
     def as_string(self, object):
         """
-        Renders and returns the JSON response as a plain string.
+        Renders and returns the JSON feed of a channel as a plain string.
         """
-        request = RequestFactory().get('')
-        response = self.as_view()(request, channel=object.channel_id)
-        return response.content
+        messages = ChatMessage.messages.feed().filter(channel=object)
+        return ''.join(iter_channel_feed(object, messages, next_cursor=None))
 
     def get_chat_messages(self, channel):
         """
         Get all the messages from channel not marked as deleted.
         """
-        if ChatChannel.objects.filter(channel_id=channel).exists():
+        try:
             self.channel = ChatChannel.objects.get(channel_id=channel)
-            self.messages = ChatMessage.messages.live().filter(
-                channel__channel_id=channel
-            )
-            return True
-        else:
+        except ChatChannel.DoesNotExist:
             return False
 
+        self.messages = ChatMessage.messages.feed().filter(
+            channel=self.channel
+        )
+        return True
+
+    def get_page_params(self):
+        """
+        Reads and validates the pagination parameters of the request.
+        Raises ValueError if one of them is invalid.
+        """
+        params = {}
+        for name in ('since_ts', 'before_ts'):
+            value = self.request.GET.get(name)
+            if value is not None and not TS_REGEX.match(value):
+                raise ValueError('%s must be a Slack timestamp.' % name)
+            params[name] = value
+
+        limit = self.request.GET.get('limit')
+        if limit is not None:
+            if not limit.isdigit() or not 0 < int(limit) <= settings.CHAT_API_MAX_LIMIT:
+                raise ValueError('limit must be between 1 and %s.' % settings.CHAT_API_MAX_LIMIT)
+            limit = int(limit)
+        params['limit'] = limit
+
+        return params
+
+    def paginate(self, since_ts=None, before_ts=None, limit=None):
+        """
+        Narrows the messages down to the requested page.
+        """
+        messages = self.messages
+        if since_ts:
+            messages = messages.filter(ts__gt=since_ts)
+        if before_ts:
+            messages = messages.filter(ts__lt=before_ts)
+
+        self.next_cursor = None
+        if limit is None:
+            self.messages = messages
+            return
+
+        # Fetch an extra message to know if there's a following page
+        if since_ts:
+            page = list(messages.order_by('ts')[:limit + 1])
+        else:
+            page = list(messages[:limit + 1])
+        if len(page) > limit:
+            page = page[:limit]
+            self.next_cursor = page[-1].ts
+        if since_ts:
+            page.reverse()
+        self.messages = page
+
     def get_json(self):
         """
         Creates the JSON feed structure with the necessary elements.
         """
-        output_messages = []
-        for message in self.messages:
-            output_message = {
-                'html': message.html,
-                'ts': message.ts,
-                'user': {
-                    'image_48': message.user.image_48,
-                    'display_name': message.user.display_name
-                }
-            }
-            output_messages.append(output_message)
-
-        return JsonResponse({
-            'channel': {
-                'id': self.channel.channel_id,
-                'headline': self.channel.headline,
-                'slug': self.channel.slug,
-                'description': self.channel.description,
-                'live_content': self.channel.live_content,
-            },
-            'messages': output_messages
-        })
+        return HttpResponse(
+            iter_channel_feed(self.channel, self.messages, next_cursor=self.next_cursor),
+            content_type='application/json'
+        )
 
+    @method_decorator(condition(etag_func=channel_etag, last_modified_func=channel_last_modified))
     def get(self, request, *args, **kwargs):
         """
-        Returns the latest JSON feed.
+        Returns the latest JSON feed, or a 304 if it didn't change since
+        the version the client has.
         """
+        try:
+            params = self.get_page_params()
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        # Archived channels are redirected to their snapshot without a query
+        version = get_channel_version(request, self.kwargs['channel'])
+        if version and version[2] and not any(params.values()):
+            response = redirect_to_snapshot(version[2])
+            if response is not None:
+                return response
+
         if self.get_chat_messages(self.kwargs['channel']):
+            self.paginate(**params)
             return self.get_json()
         else:
             raise Http404("Channel does not exist")
+
+
+class EventStream(object):
+    """
+    The content of a stream response. Closing it unsubscribes the client
+    even if the response was never iterated, like when the client went
+    away before the first event.
+    """
+    def __init__(self, events, broker, subscription):
+        self.events = events
+        self.broker = broker
+        self.subscription = subscription
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        self.events.close()
+        self.broker.unsubscribe(self.subscription)
+
+
+class ChatStream(View):
+    """
+    Server-Sent Events stream of the changes to a Chat channel.
+
+    Each event's id is the ts of the change, so a reconnecting client
+    resumes from where it left off through the Last-Event-ID header. If the
+    missed changes are no longer available, a `reset` event tells the client
+    to reload the whole feed.
+    """
+    def format_event(self, event):
+        return 'id: %s\nevent: %s\ndata: %s\n\n' % (
+            event['ts'],
+            event['action'],
+            json.dumps(event['data'], cls=DjangoJSONEncoder)
+        )
+
+    def stream(self, broker, subscription, backlog):
+        try:
+            yield 'retry: %d\n\n' % (settings.CHAT_STREAM_RETRY * 1000)
+            if backlog is None:
+                yield 'event: reset\ndata: {}\n\n'
+                backlog = []
+            for event in backlog:
+                yield self.format_event(event)
+
+            # Connections are closed after a while so they don't hold
+            # a server thread forever, clients reconnect and resume
+            deadline = time.time() + settings.CHAT_STREAM_TIMEOUT
+            while time.time() < deadline and not subscription.overflowed:
+                event = subscription.get(timeout=settings.CHAT_STREAM_HEARTBEAT)
+                if event is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield self.format_event(event)
+        finally:
+            broker.unsubscribe(subscription)
+
+    def get(self, request, *args, **kwargs):
+        channel = self.kwargs['channel']
+        if not ChatChannel.objects.filter(channel_id=channel).exists():
+            raise Http404("Channel does not exist")
+
+        last_event_id = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_event_id')
+        if last_event_id is not None and not TS_REGEX.match(last_event_id):
+            return HttpResponseBadRequest('Last-Event-ID must be a Slack timestamp.')
+
+        broker = get_broker()
+        try:
+            subscription, backlog = broker.subscribe(channel, last_event_id)
+        except TooManyClients:
+            metrics.inc('chat_stream_rejected_total', 'Stream clients turned away over CHAT_STREAM_MAX_CLIENTS.')
+            response = HttpResponse('Too many clients, retry later.', status=503, content_type='text/plain')
+            response['Retry-After'] = settings.CHAT_STREAM_RETRY
+            return response
+
+        response = StreamingHttpResponse(
+            EventStream(self.stream(broker, subscription, backlog), broker, subscription),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+def get_json_file(request, path):
+    """
+    Returns the path, content encoding and stat of the variant of a JSON
+    file that best matches the request's Accept-Encoding, once per request.
+    """
+    if not hasattr(request, 'chat_json_file'):
+        request.chat_json_file = (path, None, None)
+        try:
+            fullpath = safe_join(JSON_ROOT, path)
+            accepted = get_accepted_encodings(request)
+            for encoding, extension, compress in ENCODINGS:
+                if encoding in accepted and os.path.isfile('%s.%s' % (fullpath, extension)):
+                    variant_path = '%s.%s' % (path, extension)
+                    request.chat_json_file = (
+                        variant_path,
+                        encoding,
+                        os.stat(safe_join(JSON_ROOT, variant_path))
+                    )
+                    break
+            else:
+                request.chat_json_file = (path, None, os.stat(fullpath))
+        except (OSError, ValueError):
+            pass
+    return request.chat_json_file
+
+
+def json_file_etag(request, path):
+    variant_path, encoding, stat = get_json_file(request, path)
+    if stat:
+        return '%x-%x-%s' % (int(stat.st_mtime * 1000000), stat.st_size, encoding or 'identity')
+
+
+def json_file_last_modified(request, path):
+    variant_path, encoding, stat = get_json_file(request, path)
+    if stat:
+        return datetime.fromtimestamp(stat.st_mtime, utc)
+
+
+@condition(etag_func=json_file_etag, last_modified_func=json_file_last_modified)
+def serve_json(request, path):
+    """
+    Serves the published JSONP files, precompressed if the client accepts
+    it, or a 304 if the file didn't change since the version the client has.
+    """
+    variant_path, encoding, stat = get_json_file(request, path)
+    response = serve(request, variant_path, document_root=JSON_ROOT, show_indexes=True)
+    if encoding:
+        response['Content-Encoding'] = encoding
+        response['Content-Type'] = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if SNAPSHOT_REGEX.match(path):
+        # The name changes with the content
+        patch_cache_control(response, public=True, max_age=settings.CHAT_ARCHIVE_MAX_AGE, immutable=True)
+    return response
+
+
+def redirect_to_snapshot(name):
+    """
+    Redirects to the snapshot of an archived channel, or returns None if
+    it isn't stored locally. The snapshot can be cached forever, but not
+    the redirect, as the channel can be unarchived.
+    """
+    if not os.path.isfile(os.path.join(JSON_ROOT, name)):
+        return None
+    response = HttpResponseRedirect(reverse('chat_json', kwargs={'path': name}))
+    patch_cache_control(response, public=True, max_age=settings.CHAT_ARCHIVE_REDIRECT_MAX_AGE)
+    return response
+
+
+def metrics_view(request):
+    """
+    Returns the metrics of this process in the Prometheus text format.
+    """
+    token = settings.CHAT_METRICS_TOKEN
+    if token and request.META.get('HTTP_AUTHORIZATION') != 'Bearer %s' % token:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,161 @@
+"""
+Background workers that run the chat tasks off the request path.
+
+Tasks are routed by a key (the channel id) so that every event for a channel
+is handled by the same worker, in the order it was received.
+"""
+import atexit
+import logging
+import multiprocessing
+import threading
+import zlib
+from Queue import Queue
+from multiprocessing import util
+from django import db
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def run_task(task_name, args, kwargs):
+    """
+    Imports and runs a task by its dotted path.
+    """
+    db.close_old_connections()
+    try:
+        import_string(task_name)(*args, **kwargs)
+    except Exception:
+        logger.exception('Task %s failed.', task_name)
+    finally:
+        db.close_old_connections()
+
+
+def get_shard(key, count):
+    """
+    Returns a stable worker index for a routing key.
+    """
+    if key is None:
+        return 0
+    return zlib.crc32(str(key)) % count
+
+
+class BaseBackend(object):
+    """
+    Interface for the task queue backends.
+    """
+    def __init__(self, workers=1):
+        pass
+
+    def enqueue(self, task_name, args, kwargs, key=None):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class SyncBackend(BaseBackend):
+    """
+    Runs tasks immediately in the caller. Useful for development.
+    """
+    def enqueue(self, task_name, args, kwargs, key=None):
+        import_string(task_name)(*args, **kwargs)
+
+
+class ThreadBackend(BaseBackend):
+    """
+    Runs tasks in a pool of threads inside the web process.
+    """
+    def __init__(self, workers):
+        self.queues = []
+        for i in range(workers):
+            queue = Queue()
+            thread = threading.Thread(target=self.work, args=(queue,), name='chat-worker-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self.queues.append(queue)
+
+    def work(self, queue):
+        while True:
+            job = queue.get()
+            try:
+                if job is None:
+                    return
+                run_task(*job)
+            finally:
+                queue.task_done()
+
+    def enqueue(self, task_name, args, kwargs, key=None):
+        queue = self.queues[get_shard(key, len(self.queues))]
+        queue.put((task_name, args, kwargs))
+
+    def shutdown(self):
+        """
+        Waits for the queued tasks to finish and stops the threads.
+        """
+        queues, self.queues = self.queues, []
+        for queue in queues:
+            queue.put(None)
+        for queue in queues:
+            queue.join()
+
+
+def init_process():
+    # Connections inherited from the parent process can't be shared
+    db.connections.close_all()
+
+    # Exit hooks of the parent aren't inherited, publish what's pending on exit
+    from chat.scheduler import scheduler
+    util.Finalize(None, scheduler.flush_all, exitpriority=10)
+
+
+class ProcessBackend(BaseBackend):
+    """
+    Runs tasks in a pool of separate processes.
+    """
+    def __init__(self, workers):
+        self.pools = [
+            multiprocessing.Pool(1, initializer=init_process)
+            for i in range(workers)
+        ]
+
+    def enqueue(self, task_name, args, kwargs, key=None):
+        pool = self.pools[get_shard(key, len(self.pools))]
+        pool.apply_async(run_task, (task_name, args, kwargs))
+
+    def shutdown(self):
+        """
+        Waits for the queued tasks to finish and stops the processes.
+        """
+        pools, self.pools = self.pools, []
+        for pool in pools:
+            pool.close()
+        for pool in pools:
+            pool.join()
+
+
+def get_backend():
+    """
+    Returns the configured backend, starting it on first use.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                backend_class = import_string(settings.CHAT_TASK_BACKEND)
+                backend = backend_class(settings.CHAT_TASK_WORKERS)
+                atexit.register(backend.shutdown)
+                _backend = backend
+    return _backend
+
+
+def enqueue(func, args, kwargs):
+    """
+    Queues a task function. The first argument is used as the routing key.
+    """
+    task_name = '%s.%s' % (func.__module__, func.__name__)
+    key = args[0] if args else None
+    get_backend().enqueue(task_name, args, kwargs, key)